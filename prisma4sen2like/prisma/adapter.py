@@ -27,13 +27,21 @@ Each concrete ProductAdapter is dedicated to / use a specific product reader.
 import datetime
 import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
 import numpy as np
-from geometry import VrtRasterBand, ortho_rectify, reframe_band_file
+from geometry import (
+    GeolocatedVrt,
+    VrtRasterBand,
+    build_geolocated_vrt,
+    ortho_rectify,
+    reframe_band_file,
+)
 from mgrs_util import get_mgrs_geo_info, get_tile
 from numpy.typing import NDArray
-from PIL import Image
+from osgeo import gdal, gdal_array
 from prisma_product import PrismaProduct
 from sen2like.image_file import S2L_ImageFile
 
@@ -88,20 +96,171 @@ RASTER_BAND_INDEX = {
 BAND_IMAGE_TYPE = "uint16"
 TCI_IMAGE_TYPE = "uint8"
 
+# creation options for intermediate grids and masks, tiled for warp access.
+# Not compressed: they are read back once (or live in /vsimem), compression would only cost CPU
+GTIFF_CREATION_OPTIONS = ["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256"]
+
+
+def _write_gtiff(array: NDArray, file_path: str):
+    """Write a 2D array in a single band tiled GeoTIFF, GDAL type is deduced from array dtype
+
+    Args:
+        array (NDArray): array to write
+        file_path (str): output file path
+    """
+    _write_multiband_gtiff([array], file_path, gdal_array.NumericTypeCodeToGDALTypeCode(array.dtype))
+
+
+def _write_multiband_gtiff(arrays: list[NDArray | None], file_path: str, gdal_type: int):
+    """Write 2D arrays of the same shape as bands of a tiled GeoTIFF.
+    A band given as None is not written and is left to 0.
+
+    Args:
+        arrays (list[NDArray | None]): band arrays, at least one must not be None
+        file_path (str): output file path
+        gdal_type (int): GDAL data type of the bands
+    """
+    shape = next(array.shape for array in arrays if array is not None)
+    driver = gdal.GetDriverByName("GTiff")
+    dataset = driver.Create(file_path, shape[1], shape[0], len(arrays), gdal_type, options=GTIFF_CREATION_OPTIONS)
+    for band_number, array in enumerate(arrays, start=1):
+        if array is not None:
+            dataset.GetRasterBand(band_number).WriteArray(array)
+    # this is the way to close gdal dataset
+    dataset = None
+
+
+def _gps_knots(v):
+    """Extract GPS update knots from hold GPS values.
+    The first sample value is not an update, so it is not a knot, whatever its rank in value.
+
+    Args:
+        v (NDArray): GPS position component of each sample
+
+    Returns:
+        tuple: sample index and value of each knot, in time order
+    """
+    # first occurrence index of each unique value, in a single pass
+    u, indice = np.unique(v, return_index=True)
+    # np.unique sorts by value, put knots back in time order before dropping the first sample value
+    order = np.argsort(indice)[1:]
+    return indice[order].astype(np.float64), u[order].astype(np.float64)
+
 
 def interpolate_gps_position(v):
-    u = np.unique(v)
-    indice = []
-    for rec in u[1:]:
-        i = np.where(v == rec)[0][0]
-        indice.append(i)
-    x_0 = np.linspace(1, v.shape[0], v.shape[0])
-    # linear interpolation :
-    x = np.array(indice)
-    y = u[1:]
-    [p, o] = np.polyfit(x, y, deg=1)
+    """Interpolate GPS position of each sample (image line) from hold GPS values.
+    GPS values are updated at a lower rate than the samples, so the first sample with a new value is a knot.
+    Positions are piecewise linear between knots, and linearly extrapolated before the first and after the last.
+    Without any knot, the held value is returned. With a single knot, there is no segment to extrapolate with,
+    so positions are the knot value.
+
+    Args:
+        v (NDArray): GPS position component of each sample
+
+    Returns:
+        NDArray: interpolated position of each sample
+    """
+    x, y = _gps_knots(v)
+    if x.shape[0] == 0:
+        return np.full(v.shape[0], v[0], dtype=np.float64)
+
+    samples = np.arange(v.shape[0], dtype=np.float64)
+    positions = np.interp(samples, x, y)
+    if x.shape[0] == 1:
+        return positions
+
+    # np.interp is constant outside the knots, extrapolate with first and last segments
+    before = samples < x[0]
+    positions[before] = y[0] + (samples[before] - x[0]) * (y[1] - y[0]) / (x[1] - x[0])
+    after = samples > x[-1]
+    positions[after] = y[-1] + (samples[after] - x[-1]) * (y[-1] - y[-2]) / (x[-1] - x[-2])
+
+    return positions
 
-    return p * x_0 + o
+
+def _mean_viewing_angles(lat: NDArray, lon: NDArray, pos_x: NDArray, pos_y: NDArray, pos_z: NDArray) -> (float, float):
+    """Compute mean viewing zenith and azimuth angles from imaging point and satellite positions.
+
+    Vectors are handled component by component so that no (3, rows, cols) array is allocated,
+    and sin/cos of lat/lon are computed only once.
+    Computation is done in the dtype of the inputs (float32 expected), only means are accumulated in float64.
+
+    Args:
+        lat (NDArray): imaging point latitude grid in radians
+        lon (NDArray): imaging point longitude grid in radians
+        pos_x (NDArray): satellite ECEF x position, broadcastable to the lat/lon grids
+        pos_y (NDArray): satellite ECEF y position, broadcastable to the lat/lon grids
+        pos_z (NDArray): satellite ECEF z position, broadcastable to the lat/lon grids
+
+    Returns:
+        (float, float): mean zenith and mean azimuth angles in degrees
+    """
+    # a : major radius of the earth, 6378100 m
+    a = 6378100
+    # e : eccentricity,  0.017
+    e = 0.017
+
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    sin_lon = np.sin(lon)
+    cos_lon = np.cos(lon)
+
+    # N = a / sqrt(1 - e² sin²(lat))
+    N = np.square(sin_lat)
+    N *= -e * e
+    N += 1
+    np.sqrt(N, out=N)
+    np.divide(a, N, out=N)
+
+    # n: top vertical line (normal)
+    n_x = cos_lat * cos_lon
+    n_y = cos_lat * sin_lon
+    n_z = sin_lat
+
+    # d: directionnal vector from imaging point (p) to satellite (xb)
+    d_x = np.multiply(N, n_x)
+    np.subtract(pos_x, d_x, out=d_x)
+    d_y = np.multiply(N, n_y)
+    np.subtract(pos_y, d_y, out=d_y)
+    # N is no more needed, use it for p_z
+    d_z = N
+    d_z *= (1 - e * e) * n_z
+    np.subtract(pos_z, d_z, out=d_z)
+
+    # compute zenith
+    # zenith -> off nadir
+    # n is no more needed after the dot product, use n_x and n_y as buffers
+    r = d_x * n_x
+    np.multiply(d_y, n_y, out=n_y)
+    r += n_y
+    np.multiply(d_z, n_z, out=n_x)
+    r += n_x
+    norm = np.square(d_x)
+    norm += np.square(d_y, out=n_x)
+    norm += np.square(d_z, out=n_y)
+    np.sqrt(norm, out=norm)
+    r /= norm
+    # protect arccos against rounding drift out of [-1, 1]
+    np.clip(r, -1.0, 1.0, out=r)
+    zenith = np.arccos(r, out=r)
+    np.degrees(zenith, out=zenith)
+
+    # compute azimuth:
+    # consider directionnal vector (d)
+    # l: unit vector in x axis direction in ECR (-sin(lat)cos(lon), -sin(lat)sin(lon), cos(lat))
+    # m: unit vector in y axis direction in ECR (-sin(lon), cos(lon), 0)
+    x = np.multiply(cos_lon, d_x, out=n_x)
+    x += np.multiply(sin_lon, d_y, out=n_y)
+    x *= -sin_lat
+    x += np.multiply(cos_lat, d_z, out=norm)
+    y = np.multiply(cos_lon, d_y, out=d_y)
+    y -= np.multiply(sin_lon, d_x, out=d_x)
+    # arctan2 keeps the quadrant, then wrap to [0, 360)
+    azimuth = np.arctan2(y, x, out=y)
+    np.degrees(azimuth, out=azimuth)
+    np.mod(azimuth, 360.0, out=azimuth)
+
+    return np.mean(zenith, dtype=np.float64), np.mean(azimuth, dtype=np.float64)
 
 
 @dataclass
@@ -130,6 +289,10 @@ class MaskFileDef:
     value: str
 
 
+# Mask definitions that can be provided by the adapter, shared with the mask table of the product
+MSK_CLASSI = MaskFileDef("MSK_CLASSI", None, "MSK_CLASSI_B00.tif")
+
+
 class ProductAdapter:
     """Input product reader class Adapter (mainly for for Sen2LikeProduct)"""
 
@@ -140,10 +303,15 @@ class ProductAdapter:
         self._classi_res = classi_res
         self._classi_file = None
         self._lat_lon_alt_grid = None
+        # VRT with geolocation arrays shared by all bands
+        self._band_geolocated_vrt = None
+        # lat lon grids rotated for row/col usage
+        self._rotated_lat_lon = None
         # possible masks for prisma
-        self._mask_function_lookup = {MaskFileDef("MSK_CLASSI", None, "MSK_CLASSI_B00.tif"): self._get_classi_mask_file}
+        self._mask_function_lookup = {MSK_CLASSI: self._get_classi_mask_file}
         # band file path indexed by band name
         self._band_files = {}
+        self._band_files_lock = threading.Lock()
         self._viewing_zenith_angle = None
         self._viewing_azimuth_angle = None
         self._tile_info = None
@@ -306,33 +474,64 @@ class ProductAdapter:
 
         logger.info("Generate image file for band %s", band_name)
 
-        # Reproject and reframe
+        # band lookups done once, in locals
+        raster_band_index = RASTER_BAND_INDEX[band_name]
+        band_res = IMAGES_RES[band_name]
 
-        lat, lon, alt = self._lat_lon_alt_grid
+        # Reproject and reframe
 
         vrt_param = VrtRasterBand(
             1,
             "float32",
-            RASTER_BAND_INDEX.get(band_name),
+            raster_band_index,
             self._product.raster,
             1000,
             1000,
         )
 
-        out_file = os.path.join(self._wd, band_name + "_reframe.tif")
-        reframe_band_file(lat, lon, alt, vrt_param, IMAGES_RES.get(band_name), out_file, self.tile_info)
+        # reframed float image is only an intermediate, keep it in memory
+        reframe_file = f"/vsimem/{band_name}_reframe.tif"
+        reframe_band_file(self._band_vrt, vrt_param, band_res, reframe_file, self.tile_info, creation_options=[])
+
+        try:
+            # apply gain + offset
+            image = S2L_ImageFile(reframe_file)
+            # load it, then release the in memory file
+            image.read()
+            image.close()
+        finally:
+            gdal.Unlink(reframe_file)
 
-        # apply gain + offset
-        image = S2L_ImageFile(out_file)
-        # load it
-        image.read()
         out_file = os.path.join(self._wd, band_name + ".tif")
         image.duplicate(out_file).write(nodata_value=0)
 
         logger.info("Image file for band %s generated in %s", band_name, out_file)
-        self._band_files[band_name] = out_file
+        with self._band_files_lock:
+            self._band_files[band_name] = out_file
         return out_file
 
+    def prefetch_bands(self, bands: list[str], max_workers: int = 8):
+        """Generate image files of the given bands concurrently.
+        Bands are independent, and GDAL release the GIL, so they are generated in a thread pool.
+        Generated files are then available with 'get_band_file'.
+
+        Args:
+            bands (list[str]): names of the bands to generate
+            max_workers (int, optional): max number of concurrent band generation. Defaults to 8.
+        """
+        # lazy attributes shared by all bands MUST be set before concurrent access
+        _ = self._band_vrt
+        _ = self.tile_info
+
+        def _generate(band_name: str) -> str:
+            # parallelism is done at band level, avoid GDAL threads oversubscription
+            gdal.SetThreadLocalConfigOption("GDAL_NUM_THREADS", "1")
+            return self.get_band_file(band_name)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # consume results to raise workers exception if any
+            list(executor.map(_generate, bands))
+
     def get_mask_file(self, mask_file_def: MaskFileDef) -> str | None:
         """Get mask file path from the given definition
 
@@ -347,23 +546,41 @@ class ProductAdapter:
             return func()
         return None
 
-    def _extract_mask(self, grid, values: list[int], output_file_path: str) -> NDArray:
+    def _extract_mask(self, grid, values: list[int]) -> NDArray:
         # need to rotate original grid counterclockwise
         mask = np.rot90(grid, k=-1)
-        dest_mask = np.zeros(mask.shape).astype("uint8")
-        # set pixel with given values to 1
-        for val in values:
-            dest_mask[mask == val] = 1
-            logger.debug(dest_mask[dest_mask == val])
+        # set pixel with given values to 1, others to 0 (bool array seen as uint8 without copy)
+        dest_mask = np.isin(mask, values).view(np.uint8)
 
-        logger.debug("NB maked px %s", len(dest_mask[dest_mask >= 1]))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("NB maked px %s", np.count_nonzero(dest_mask))
+            logger.debug("maked px %s", dest_mask[dest_mask >= 1])
 
-        logger.debug("maked px %s", dest_mask[dest_mask >= 1])
-
-        image = Image.fromarray(dest_mask)
-        image.save(output_file_path)
         return dest_mask
 
+    @property
+    def _rotated_lat_lon_grids(self) -> (NDArray, NDArray):
+        """Product lat lon grids rotated for row/col usage, read and rotated only once.
+
+        Returns:
+            tuple: lat lon grids
+        """
+        if self._rotated_lat_lon is None:
+            lat_lon_grids = self._product.lat_lon_grids
+            # need to rotate original grid conterclockwize
+            self._rotated_lat_lon = (
+                np.ascontiguousarray(np.rot90(lat_lon_grids[0], k=-1)),
+                np.ascontiguousarray(np.rot90(lat_lon_grids[1], k=-1)),
+            )
+
+        return self._rotated_lat_lon
+
+    @property
+    def _band_vrt(self) -> GeolocatedVrt:
+        if self._band_geolocated_vrt is None:
+            self._band_geolocated_vrt = build_geolocated_vrt(1000, 1000, *self._lat_lon_grid_files)
+        return self._band_geolocated_vrt
+
     @property
     def _lat_lon_grid_files(self):
         if self._lat_lon_alt_grid:
@@ -371,26 +588,20 @@ class ProductAdapter:
 
         logger.info("Extract Lat Lon grids")
 
-        lat_lon_grids = self._product.lat_lon_grids
-        # need to rotate original grid conterclockwize
-        lat_grid = np.rot90(lat_lon_grids[0], k=-1)
-        lon_grid = np.rot90(lat_lon_grids[1], k=-1)
+        lat_grid, lon_grid = self._rotated_lat_lon_grids
 
         # lat grid file
         prod_lat = os.path.join(self._wd, "lat.tif")
-        image = Image.fromarray(lat_grid)
-        image.save(prod_lat)
+        _write_gtiff(lat_grid, prod_lat)
 
         # lon grid file
         prod_lon = os.path.join(self._wd, "lon.tif")
-        image = Image.fromarray(lon_grid)
-        image.save(prod_lon)
+        _write_gtiff(lon_grid, prod_lon)
 
         # alt grid file
         alt_grid = np.zeros(lat_grid.shape)
         prod_alt = os.path.join(self._wd, "alt.tif")
-        image = Image.fromarray(alt_grid)
-        image.save(prod_alt)
+        _write_gtiff(alt_grid, prod_alt)
 
         self._lat_lon_alt_grid = (prod_lat, prod_lon, prod_alt)
 
@@ -404,41 +615,42 @@ class ProductAdapter:
         logger.info("Extract MSK_CLASSI in %s", self._classi_file)
 
         # cloud mask
-        cloud_mask_file = os.path.join(self._wd, "cloud_mask.tif")
-        logger.info("Extract cloud px to %s", cloud_mask_file)
+        logger.info("Extract cloud px")
         # keep only pixel with 1 (cloud)
-        cloud_mask = self._extract_mask(self._product.cloud_mask_grid, [1], cloud_mask_file)
+        cloud_mask = self._extract_mask(self._product.cloud_mask_grid, [1])
+        logger.info("NB cloudy px: %s", np.count_nonzero(cloud_mask))
 
         # snow mask
-        snow_mask_file = os.path.join(self._wd, "snow_mask.tif")
-        logger.info("Extract snow px to %s", snow_mask_file)
+        logger.info("Extract snow px")
         # keep only pixel with 1 (snow)
-        snow_mask = self._extract_mask(self._product.land_mask_grid, [1], snow_mask_file)
+        snow_mask = self._extract_mask(self._product.land_mask_grid, [1])
 
-        # dummy cirrus mask, needed for MASK_CLASSI
-        cirrus_mask = np.zeros(cloud_mask.shape).astype("uint8")
-        cirrus_mask_file = os.path.join(self._wd, "cirrus_mask.tif")
-        image = Image.fromarray(cirrus_mask)
-        image.save(cirrus_mask_file)
+        # single in memory 3 bands file: cloud, snow, and dummy cirrus (left to 0), needed for MASK_CLASSI
+        mask_stack_file = "/vsimem/classi_mask_stack.tif"
+        _write_multiband_gtiff([cloud_mask, snow_mask, None], mask_stack_file, gdal.GDT_Byte)
 
         # create VRT input band params
-        cloud_raster_param = VrtRasterBand(1, "Byte", 1, cloud_mask_file, cloud_mask.shape[1], cloud_mask.shape[0])
-        snow_raster_param = VrtRasterBand(2, "Byte", 1, snow_mask_file, snow_mask.shape[1], snow_mask.shape[0])
-        cirrus_raster_param = VrtRasterBand(3, "Byte", 1, cirrus_mask_file, cirrus_mask.shape[1], cirrus_mask.shape[0])
+        ysize, xsize = cloud_mask.shape
+        raster_params = [
+            VrtRasterBand(band_number, "Byte", band_number, mask_stack_file, xsize, ysize) for band_number in (1, 2, 3)
+        ]
 
         lat_lon_grid_files = self._lat_lon_grid_files
 
-        ortho_rectify(
-            lat_lon_grid_files[0],
-            lat_lon_grid_files[1],
-            lat_lon_grid_files[2],
-            [cloud_raster_param, snow_raster_param, cirrus_raster_param],
-            cloud_mask.shape,
-            self._classi_file,
-            self._classi_res,
-            self.tile_info,
-            is_mask=True,
-        )
+        try:
+            ortho_rectify(
+                lat_lon_grid_files[0],
+                lat_lon_grid_files[1],
+                lat_lon_grid_files[2],
+                raster_params,
+                cloud_mask.shape,
+                self._classi_file,
+                self._classi_res,
+                self.tile_info,
+                is_mask=True,
+            )
+        finally:
+            gdal.Unlink(mask_stack_file)
 
         logger.info("Extract MSK_CLASSI finished")
         return self._classi_file
@@ -467,65 +679,25 @@ class ProductAdapter:
         Bit[31] = sign,     Bit[30:23] = exp ,     Bit[22:0] = mantissa
         """
 
-        pos_x = interpolate_gps_position(np.array(list(self._product.product["Info/Ancillary/PVSdata/Wgs84_pos_x"])))
-        pos_y = interpolate_gps_position(np.array(list(self._product.product["Info/Ancillary/PVSdata/Wgs84_pos_y"])))
-        pos_z = interpolate_gps_position(np.array(list(self._product.product["Info/Ancillary/PVSdata/Wgs84_pos_z"])))
+        pos_x = interpolate_gps_position(self._product.product["Info/Ancillary/PVSdata/Wgs84_pos_x"][:])
+        pos_y = interpolate_gps_position(self._product.product["Info/Ancillary/PVSdata/Wgs84_pos_y"][:])
+        pos_z = interpolate_gps_position(self._product.product["Info/Ancillary/PVSdata/Wgs84_pos_z"][:])
 
-        lat_lon_grids = self._product.lat_lon_grids
+        lat_grid, lon_grid = self._rotated_lat_lon_grids
 
-        lat = np.pi / 180.0 * np.rot90(lat_lon_grids[0], k=-1)
-        lon = np.pi / 180.0 * np.rot90(lat_lon_grids[1], k=-1)
-
-        shape = lat.shape
-
-        # a : major radius of the earth, 6378100 m
-        a = 6378100
-        # e : eccentricity,  0.017
-        e = 0.017
-
-        N = np.divide(a, np.power(1 - (e * e * np.sin(lat) * np.sin(lat)), 0.5))
-
-        # Poistion vector of imaging point
-        p = np.array([N * np.cos(lat) * np.cos(lon), N * np.cos(lat) * np.sin(lon), (1 - e * e) * N * np.sin(lat)])
-
-        # n: top vertical line (normal)
-        n = np.array([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+        lat = np.radians(lat_grid, dtype=np.float32)
+        lon = np.radians(lon_grid, dtype=np.float32)
 
         # xb: position of the satellite (ECEF), clip to be within image frame
-        # xb = np.array([pos_x[60:-60], pos_y[60:-60], pos_z[60:-60]])
-        # lxb = (np.tile(xb, shape[1])).reshape(3, shape[0], shape[1])
-        M_pos_x = np.rot90((np.tile(pos_x[60:-60], 1000).reshape(1000, 1000)), -1)
-        M_pos_y = np.rot90((np.tile(pos_y[60:-60], 1000).reshape(1000, 1000)), -1)
-        M_pos_z = np.rot90((np.tile(pos_z[60:-60], 1000).reshape(1000, 1000)), -1)
-        lxb = np.array([M_pos_x, M_pos_y, M_pos_z])
-
-        # d: directionnal vector from imaging point :
-        d = lxb - p
-
-        # compute zenith
-        res = np.sum(d * n, 0)
-        res2 = np.power(np.sum(d * d, 0), 0.5)
-        r = res / res2
-        zenith = (np.arccos(res / res2)) * 180 / np.pi
-        # zenith -> off nadir
-
-        # compute azimuth:
-        # consider directionnal vector (d)
-
-        # l: unit vector in x axis direction in ECR
-        l = np.array([-np.sin(lat) * np.cos(lon), -np.sin(lat) * np.sin(lon), np.cos(lat)])
-        # m: unit vector in y axis direction in ECR
-        m = np.array([-np.sin(lon), np.cos(lon), np.zeros([shape[0], shape[1]])])
-
-        x = np.sum(l * d, 0)
-        y = np.sum(m * d, 0)
-        # azimuth = np.arctan(y / x) * 180.0 / np.pi
-        azimuth = np.degrees(np.arctan(y / x))
-
-        azimuth[azimuth < 0] = azimuth[azimuth < 0] + 360
-
-        self._viewing_zenith_angle = np.mean(zenith)
-        self._viewing_azimuth_angle = np.mean(azimuth)
+        # one position per row of the rotated grids, as column vectors they are broadcast
+        # along the columns (same as np.rot90(np.tile(pos[60:-60], 1000).reshape(1000, 1000), -1))
+        self._viewing_zenith_angle, self._viewing_azimuth_angle = _mean_viewing_angles(
+            lat,
+            lon,
+            pos_x[60:-60, np.newaxis].astype(np.float32),
+            pos_y[60:-60, np.newaxis].astype(np.float32),
+            pos_z[60:-60, np.newaxis].astype(np.float32),
+        )
 
     @property
     def viewing_angle_grid(self) -> AngleGrid:
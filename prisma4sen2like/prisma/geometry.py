@@ -18,7 +18,7 @@
 """Geometry module to reframe and reproject into MGRS UTM"""
 import logging
 import os
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass
 
 from osgeo import gdal
 from sen2like.grids import MGRSGeoInfo
@@ -42,14 +42,16 @@ class VrtRasterBand:
     ysize: int
 
 
-VRT_RASTER_BAND_TEMPLATE = """
-    <VRTRasterBand band="{band_number}" dataType="{datatype}">
+def _vrt_raster_band_xml(src: VrtRasterBand) -> str:
+    """Get VRTRasterBand element of the given source band param"""
+    return f"""
+    <VRTRasterBand band="{src.band_number}" dataType="{src.datatype}">
         <SimpleSource>
-            <SourceFilename relativeToVRT="1">{srcfile}</SourceFilename>
-            <SourceBand>{band}</SourceBand>
-            <SourceProperties RasterXSize="{xsize}" RasterYSize="{ysize}" DataType="{datatype}"/>
-            <SrcRect xOff="0" yOff="0" xSize="{xsize}" ySize="{ysize}"/>
-            <DstRect xOff="0" yOff="0" xSize="{xsize}" ySize="{ysize}"/>
+            <SourceFilename relativeToVRT="0">{src.srcfile}</SourceFilename>
+            <SourceBand>{src.band}</SourceBand>
+            <SourceProperties RasterXSize="{src.xsize}" RasterYSize="{src.ysize}" DataType="{src.datatype}"/>
+            <SrcRect xOff="0" yOff="0" xSize="{src.xsize}" ySize="{src.ysize}"/>
+            <DstRect xOff="0" yOff="0" xSize="{src.xsize}" ySize="{src.ysize}"/>
         </SimpleSource>
     </VRTRasterBand>"""
 
@@ -76,6 +78,59 @@ VRT_TEMPLATE = """
 </VRTDataset>"""
 
 
+@dataclass
+class GeolocatedVrt:
+    """VRT content with geolocation arrays, pre-formatted around its raster band list.
+    It allows to build several VRT with the same geolocation arrays without formatting them again.
+    """
+
+    head: str
+    """VRT content before the raster band list"""
+    tail: str
+    """VRT content after the raster band list (geolocation metadata)"""
+
+    def with_bands(self, sources: list[VrtRasterBand]) -> str:
+        """Get VRT content for the given source bands
+
+        Args:
+            sources (list[VrtRasterBand]): source band params
+
+        Returns:
+            str: VRT content
+        """
+        return self.head + "".join(_vrt_raster_band_xml(src) for src in sources) + self.tail
+
+
+def build_geolocated_vrt(xsize: int, ysize: int, prod_lat: str, prod_lon: str, prod_alt: str) -> GeolocatedVrt:
+    """Format VRT template with size and geolocation arrays, leaving raster band list to be set
+
+    Args:
+        xsize (int): VRT raster x size
+        ysize (int): VRT raster y size
+        prod_lat (str): latitude grid file
+        prod_lon (str): longitude grid file
+        prod_alt (str): altitude grid file
+
+    Returns:
+        GeolocatedVrt: pre-formatted VRT
+    """
+    head, tail = VRT_TEMPLATE.split("{vrt_raster_band_list}")
+    return GeolocatedVrt(
+        head.format(xsize=xsize, ysize=ysize),
+        tail.format(altfile=prod_alt, latfile=prod_lat, lonfile=prod_lon),
+    )
+
+
+# Warp creation options of final outputs (ortho rectified MSK_CLASSI is copied as is in the product),
+# compression use all cores. Intermediate outputs, only read back once, are not compressed
+WARP_CREATION_OPTIONS = ["TILED=YES", "COMPRESS=LZW", "NUM_THREADS=ALL_CPUS"]
+
+
+def _in_memory_vrt_path(dest_file: str) -> str:
+    """Get the GDAL in memory (/vsimem/) path of the VRT used to produce the given file"""
+    return f"/vsimem/{os.path.splitext(os.path.basename(dest_file))[0]}.vrt"
+
+
 def ortho_rectify(
     prod_lat: str,
     prod_lon: str,
@@ -107,27 +162,12 @@ def ortho_rectify(
 
     ysize, xsize = shape
 
-    file_parts = os.path.splitext(dest_file)
-
-    # vrt creation
-    vrt_file = dest_file.replace(file_parts[1], ".vrt")
-
-    vrt_raster_band_list = ""
-    for vrt_src in sources:
-        vrt_raster_band_list += VRT_RASTER_BAND_TEMPLATE.format(**asdict(vrt_src))
-
-    vrt_content = VRT_TEMPLATE.format(
-        xsize=xsize,
-        ysize=ysize,
-        vrt_raster_band_list=vrt_raster_band_list,
-        altfile=prod_alt,
-        latfile=prod_lat,
-        lonfile=prod_lon,
-    )
+    vrt_content = build_geolocated_vrt(xsize, ysize, prod_lat, prod_lon, prod_alt).with_bands(sources)
 
     logger.debug(vrt_content)
-    with open(vrt_file, "w") as fid:
-        fid.write(vrt_content)
+    # vrt creation, in memory
+    vrt_file = _in_memory_vrt_path(dest_file)
+    gdal.FileFromMemBuffer(vrt_file, vrt_content.encode())
 
     # warp
     resample_alg = "near" if is_mask else "bilinear"
@@ -140,7 +180,7 @@ def ortho_rectify(
     options = gdal.WarpOptions(
         # options=f"-s_srs EPSG:4326 -t_srs EPSG:{tile_info.epsg} -tr {dest_res} {dest_res} -te {tile_info.geometry.bounds[0]} {tile_info.geometry.bounds[1]} {tile_info.geometry.bounds[2]} {tile_info.geometry.bounds[3]} -r {resample_alg}",  # -ovr NONE",# -dstnodata {dst_nodata} ",#-r {resampleAlg}",
         resampleAlg=resample_alg,
-        creationOptions=["COMPRESS=LZW"],
+        creationOptions=WARP_CREATION_OPTIONS,
         srcSRS="EPSG:4326",
         dstSRS="EPSG:" + tile_info.epsg,
         xRes=dest_res,
@@ -150,44 +190,45 @@ def ortho_rectify(
         # overviewLevel="NONE"
     )
 
-    gdal.Warp(dest_file, vrt_file, options=options)
-
-    # Read final image
-    # data = io.imread(output_name, cv2.IMREAD_GRAYSCALE)
-    # return data, output_name
-    src_ds = gdal.Open(dest_file)
-    # src_ds = gdal.Open("/tmp/prisma_dev/1680773663593/classi_mask_ortho_jeudi.jp2")
-    data = src_ds.GetRasterBand(1)
-    data_array = data.ReadAsArray()
-    logger.info(f"NB cloudy px: {len(data_array[data_array == 1])}")
-    print(data_array[data_array >= 1])
-    # data = src_ds.GetRasterBand(2)
-    # data_array = data.ReadAsArray()
-    # logger.info(f"NB snowy px: {len(data_array[data_array == 1])}")
-
-
-def reframe_band_file(prod_lat, prod_lon, prod_alt, vrt_param, output_res, output_file, tile_info):
-    file_parts = os.path.splitext(output_file)
-    # vrt creation
-    vrt_file = output_file.replace(file_parts[1], ".vrt")
-
-    vrt_content = VRT_TEMPLATE.format(
-        xsize=1000,
-        ysize=1000,
-        vrt_raster_band_list=VRT_RASTER_BAND_TEMPLATE.format(**asdict(vrt_param)),
-        altfile=prod_alt,
-        latfile=prod_lat,
-        lonfile=prod_lon,
-    )
+    try:
+        gdal.Warp(dest_file, vrt_file, options=options)
+    finally:
+        gdal.Unlink(vrt_file)
+
+
+def reframe_band_file(
+    geolocated_vrt: GeolocatedVrt,
+    vrt_param: VrtRasterBand,
+    output_res: float,
+    output_file: str,
+    tile_info: MGRSGeoInfo,
+    creation_options: list[str] = None,
+):
+    """Project and reframe a source band raster in MGRS tile.
+
+    Args:
+        geolocated_vrt (GeolocatedVrt): pre-formatted VRT with geolocation arrays
+        vrt_param (VrtRasterBand): source band param
+        output_res (float): destination pixel resolution
+        output_file (str): destination file
+        tile_info (MGRSGeoInfo): destination MGRS tile definition.
+        creation_options (list[str], optional): output creation options.
+            Defaults to none, the reframed band is an intermediate.
+    """
+    if creation_options is None:
+        creation_options = []
+
+    vrt_content = geolocated_vrt.with_bands([vrt_param])
 
     logger.debug(vrt_content)
-    with open(vrt_file, "w") as fid:
-        fid.write(vrt_content)
+    # vrt creation, in memory
+    vrt_file = _in_memory_vrt_path(output_file)
+    gdal.FileFromMemBuffer(vrt_file, vrt_content.encode())
 
     options = gdal.WarpOptions(
         # options=f"-s_srs EPSG:4326 -t_srs EPSG:{tile_info.epsg} -tr {output_res} {output_res} -te {tile_info.geometry.bounds[0]} {tile_info.geometry.bounds[1]} {tile_info.geometry.bounds[2]} {tile_info.geometry.bounds[3]}",# -ot UInt16",  # -ovr NONE",# -dstnodata {dst_nodata} ",#-r {resampleAlg}",
         resampleAlg="bilinear",
-        creationOptions=["COMPRESS=LZW"],
+        creationOptions=creation_options,
         srcSRS="EPSG:4326",
         dstSRS="EPSG:" + tile_info.epsg,
         xRes=output_res,
@@ -197,4 +238,7 @@ def reframe_band_file(prod_lat, prod_lon, prod_alt, vrt_param, output_res, outpu
         # overviewLevel="NONE"
     )
 
-    gdal.Warp(output_file, vrt_file, options=options)
+    try:
+        gdal.Warp(output_file, vrt_file, options=options)
+    finally:
+        gdal.Unlink(vrt_file)
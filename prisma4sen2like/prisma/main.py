@@ -19,15 +19,11 @@
 import logging
 import os
 import sys
+import tempfile
 import time
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, ArgumentTypeError
 
-from adapter import ProductAdapter
 from log import configure_logging
-from prisma_product import PrismaProduct
-from prisma_s2_spectral_aggregation import SpectralAggregation
-from product_builder import Sen2LikeProductBuilder
-from sen2like_product import Sen2LikeProduct
 from version import __version__ as version
 
 logger = logging.getLogger(__name__)
@@ -69,6 +65,28 @@ _arg_parser.add_argument(
     dest="destination_dir", type=_validate_folder, help="Generated S2P destination folder", metavar="DESTINATION_FOLDER"
 )
 _arg_parser.add_argument(dest="working_dir", type=_validate_folder, help="Working directory", metavar="WORKING_DIR")
+_arg_parser.add_argument(
+    "--write-radiance",
+    dest="write_radiance",
+    action="store_true",
+    help="Also write S2P TOA radiance image in working directory",
+)
+_arg_parser.add_argument(
+    "--gdal-cache-max",
+    dest="gdal_cache_max",
+    type=int,
+    default=None,
+    help="GDAL block cache size in MB, GDAL default (or GDAL_CACHEMAX) when not set",
+    metavar="MB",
+)
+_arg_parser.add_argument(
+    "--gdal-swath-size",
+    dest="gdal_swath_size",
+    type=int,
+    default=None,
+    help="GDAL translate swath size in MB, GDAL default (or GDAL_SWATH_SIZE) when not set",
+    metavar="MB",
+)
 
 
 ############################################################
@@ -83,18 +101,38 @@ def main(argv: list[str]):
     """
     args = _arg_parser.parse_args(argv)
 
+    # GDAL process wide settings, set before GDAL is loaded.
+    # Decode/encode tiles with all cores (band generation restricts it per thread), user environment takes precedence
+    os.environ.setdefault("GDAL_NUM_THREADS", "ALL_CPUS")
+    # Block cache and translate swath only on demand, they depend on the host memory
+    if args.gdal_cache_max is not None:
+        os.environ["GDAL_CACHEMAX"] = str(args.gdal_cache_max)
+    if args.gdal_swath_size is not None:
+        os.environ["GDAL_SWATH_SIZE"] = str(args.gdal_swath_size * 1024 * 1024)
+
+    # processing modules pull in GDAL, h5py, scipy and friends,
+    # import them only once args are valid so that CLI usage and errors stay fast
+    # pylint: disable=import-outside-toplevel
+    from adapter import ProductAdapter
+    from prisma_product import PrismaProduct
+    from prisma_s2_spectral_aggregation import SpectralAggregation
+    from product_builder import Sen2LikeProductBuilder
+    from sen2like_product import Sen2LikeProduct
+
     configure_logging(False, False)
 
     logger.info("Start P4S2L %s with Python %s", version, sys.version)
-    # create workdir
-    working_dir = os.path.join(args.working_dir, str(round(time.time() * 1000)))
-    os.mkdir(working_dir)
+    # product dir, named after the input product, only keeps what a re-run reuses (aggregation coefficients)
+    product_dir = os.path.join(args.working_dir, os.path.splitext(os.path.basename(args.product_file_path))[0])
+    os.makedirs(product_dir, exist_ok=True)
+    # create a fresh workdir in it for this run outputs, so that nothing is left over from a previous run
+    working_dir = tempfile.mkdtemp(prefix=f"{round(time.time() * 1000)}_", dir=product_dir)
     logger.info("Working dir: %s", working_dir)
 
     # configure input product, adapter, sen2like product and builder
     product = PrismaProduct(args.product_file_path)
-    spectral_aggregation = SpectralAggregation(product, working_dir)
-    rad, ref = spectral_aggregation.process()
+    spectral_aggregation = SpectralAggregation(product, working_dir, args.write_radiance, coefficients_dir=product_dir)
+    _, ref = spectral_aggregation.process()
     adapter = ProductAdapter(product, working_dir, 60.0)
     product.raster = ref
     product.sun_earth_correction = spectral_aggregation.sun_earth_correction
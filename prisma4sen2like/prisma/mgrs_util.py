@@ -21,6 +21,8 @@
 >>> m.toMGRS(41.79915237426758, 12.32413101196289)
 '33TTG7768630938'
 """
+from functools import lru_cache
+
 import mgrs
 from geometry import LatLong
 from sen2like.grids import GridsConverter, MGRSGeoInfo
@@ -29,8 +31,10 @@ from shapely.wkt import loads
 _MGRS = mgrs.MGRS()
 
 
+@lru_cache(maxsize=256)
 def get_mgrs_geo_info(tile_code: str) -> MGRSGeoInfo:
-    """Get MGRS geo information of the given tile
+    """Get MGRS geo information of the given tile.
+    Result is memoized by tile code, it must not be modified
 
     Args:
         tile_code (str): mgrs tile code
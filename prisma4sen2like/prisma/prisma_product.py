@@ -19,11 +19,10 @@
 from datetime import datetime, timedelta
 
 import h5py
-import numpy as np
 from dateutil import parser, tz
 from geometry import LatLong
 from numpy.typing import NDArray
-from utils import utc_format
+from utils import read_dataset, utc_format
 
 PrismaProductFile = h5py.File
 
@@ -50,6 +49,8 @@ class PrismaProduct:
     _sun_zenith_angle: float = None
     _sun_earth_correction: float = None
     _cloudy_pixel_percentage: float = None
+    _scene_center_coordinates: LatLong = None
+    _scene_center_date: datetime = None
 
     def __init__(self, file_path):
         self.file_path: str = file_path
@@ -173,30 +174,40 @@ class PrismaProduct:
         """Get product scene center as lat lon.
         Lat long are read from 'HDFEOS/SWATHS/PRS_L1_HCO/Geolocation Fields/' VNIR dataset
 
+        This property is set at first access by checking if 'None'.
+
         Returns:
             LatLong: scene center coord
         """
-        return LatLong(
-            self.product["HDFEOS/SWATHS/PRS_L1_HCO/Geolocation Fields/Latitude_VNIR"][499, 499],
-            self.product["HDFEOS/SWATHS/PRS_L1_HCO/Geolocation Fields/Longitude_VNIR"][499, 499],
-        )
+        if self._scene_center_coordinates is None:
+            self._scene_center_coordinates = LatLong(
+                self.product["HDFEOS/SWATHS/PRS_L1_HCO/Geolocation Fields/Latitude_VNIR"][499, 499],
+                self.product["HDFEOS/SWATHS/PRS_L1_HCO/Geolocation Fields/Longitude_VNIR"][499, 499],
+            )
+
+        return self._scene_center_coordinates
 
     @property
     def scene_center_date(self) -> datetime:
         """Get product scene center UTC date and time.
         Time info is read from 'HDFEOS/SWATHS/PRS_L1_HCO/Time/' VNIR dataset
 
+        This property is set at first access by checking if 'None'.
+
         Returns:
             datetime: scene center UTC date and time
         """
-        time = self.product["HDFEOS/SWATHS/PRS_L1_HCO/Geolocation Fields/Time"][499]
-        # time is MJD2000 so add it as days to 2000/1/1 to "real" date time
-        return (datetime(2000, 1, 1, 0, 0) + timedelta(days=time)).replace(tzinfo=tz.tzutc())
+        if self._scene_center_date is None:
+            time = self.product["HDFEOS/SWATHS/PRS_L1_HCO/Geolocation Fields/Time"][499]
+            # time is MJD2000 so add it as days to 2000/1/1 to "real" date time
+            self._scene_center_date = (datetime(2000, 1, 1, 0, 0) + timedelta(days=time)).replace(tzinfo=tz.tzutc())
+
+        return self._scene_center_date
 
     def _get_mask_grid(self, path) -> NDArray | None:
         grid = self.product.get(path)
-        if grid:
-            return np.array(grid)
+        if grid is not None:
+            return read_dataset(grid)
         return None
 
     @property
@@ -253,6 +264,6 @@ class PrismaProduct:
             tuple: lat lon grids
         """
         return (
-            np.array(self.product["HDFEOS/SWATHS/PRS_L1_HCO/Geolocation Fields/Latitude_VNIR"]),
-            np.array(self.product["HDFEOS/SWATHS/PRS_L1_HCO/Geolocation Fields/Longitude_VNIR"]),
+            read_dataset(self.product["HDFEOS/SWATHS/PRS_L1_HCO/Geolocation Fields/Latitude_VNIR"]),
+            read_dataset(self.product["HDFEOS/SWATHS/PRS_L1_HCO/Geolocation Fields/Longitude_VNIR"]),
         )
@@ -17,13 +17,22 @@
 # limitations under the License.
 
 import logging
+import math
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 from osgeo import gdal
 from prisma_product import PrismaProduct
-from spectral_aggregation_functions import *
-from sunpy.coordinates import sun
+from spectral_aggregation_functions import (
+    aggregation_coefficients_key,
+    generate_aggregation_coefficients_prisma_s2,
+    radiance_to_reflectance,
+    read_cube_to_radiance,
+    spectral_aggregation_prisma_s2,
+    sun_earth_correction,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -46,13 +55,31 @@ _ESUN = np.array(
     ]
 )
 
+# Float32 S2P cubes, tiled and compressed with the floating point predictor
+S2P_CREATION_OPTIONS = [
+    "TILED=YES",
+    "BLOCKXSIZE=512",
+    "BLOCKYSIZE=512",
+    "COMPRESS=ZSTD",
+    "PREDICTOR=3",
+    "INTERLEAVE=BAND",
+    "BIGTIFF=IF_SAFER",
+    "NUM_THREADS=ALL_CPUS",
+]
+
 
 class SpectralAggregation:
-    def __init__(self, product: PrismaProduct, work_dir: str):
+    def __init__(
+        self, product: PrismaProduct, work_dir: str, write_radiance: bool = False, coefficients_dir: str = None
+    ):
         self._product = product
         # shortcut to h5py.File
         self._product_file = product.product
         self._work_dir = work_dir
+        # aggregation coefficients files can be shared between runs, they are in work dir by default
+        self._coefficients_dir = coefficients_dir or work_dir
+        # TOA radiance image is not consumed downstream, only write it on demand
+        self._write_radiance = write_radiance
         self._p_prisma_vnir = None
         self._p_prisma_swir = None
         self._sun_earth_distance = None
@@ -61,18 +88,20 @@ class SpectralAggregation:
     def _generate_coefficients(self):
         start_time = time.time()
 
-        # Create Coefficients output filename
+        # Create Coefficients output filenames, one plain npy file per sensor so that they can be memory mapped.
+        # Named after the inputs coefficients are generated from, so that a stale file is never reused
         s2p_aggregation_coefficients_file = os.path.join(
-            self._work_dir, "S2P_aggregation_coefficients_P_full_frame_v3.npz"
+            self._coefficients_dir,
+            f"S2P_aggregation_coefficients_P_full_frame_v3_{aggregation_coefficients_key(self._product_file)}",
         )
+        vnir_coefficients_file = f"{s2p_aggregation_coefficients_file}.vnir.npy"
+        swir_coefficients_file = f"{s2p_aggregation_coefficients_file}.swir.npy"
 
-        if os.path.exists(s2p_aggregation_coefficients_file):
-            logger.info("Read all aggregation coefficients from numpy saved file")
-
-            npz_file = np.load(s2p_aggregation_coefficients_file, allow_pickle=True)
+        if os.path.exists(vnir_coefficients_file) and os.path.exists(swir_coefficients_file):
+            logger.info("Read all aggregation coefficients from numpy saved files")
 
-            self._p_prisma_vnir = npz_file["p_prisma_vnir"]
-            self._p_prisma_swir = npz_file["p_prisma_swir"]
+            self._p_prisma_vnir = np.load(vnir_coefficients_file, mmap_mode="r")
+            self._p_prisma_swir = np.load(swir_coefficients_file, mmap_mode="r")
 
         else:
             logger.info("Generate aggregation coefficients")
@@ -80,10 +109,15 @@ class SpectralAggregation:
             # Compute spectral aggregation coefficients (PRISMA => S2-MSI-A)
             self._p_prisma_vnir, self._p_prisma_swir = generate_aggregation_coefficients_prisma_s2(self._product_file)
 
-            np.savez(
-                s2p_aggregation_coefficients_file, p_prisma_vnir=self._p_prisma_vnir, p_prisma_swir=self._p_prisma_swir
-            )
-            logger.info("Coefficients saved to file %s", s2p_aggregation_coefficients_file)
+            for coefficients_file, coefficients in (
+                (vnir_coefficients_file, self._p_prisma_vnir),
+                (swir_coefficients_file, self._p_prisma_swir),
+            ):
+                # write then rename, so that an interrupted run never leaves a truncated file to be reused
+                with open(f"{coefficients_file}.part", "wb") as file:
+                    np.save(file, coefficients)
+                os.replace(f"{coefficients_file}.part", coefficients_file)
+            logger.info("Coefficients saved to files %s and %s", vnir_coefficients_file, swir_coefficients_file)
 
         logger.info("Aggregation coefficients loaded")
 
@@ -95,11 +129,9 @@ class SpectralAggregation:
             return self._sun_earth_distance
 
         product_start_time = self._product.product_start_time
-        sun_earth_distance = sun.earth_distance(product_start_time.raw).value
         sun_earth_correction_esa, sun_earth_distance_esa = sun_earth_correction(product_start_time.as_datetime)
         sza = self._product.sun_zenith_angle
 
-        logger.info(f"Sun Earth distance = {sun_earth_distance:.9f} AU; sza = {sza:.4f} deg")
         logger.info(f"Sun Earth distance ESA = {sun_earth_distance_esa:.9f} AU; sza = {sza:.4f} deg")
         logger.info(f"Sun Earth correction ESA <U> = {sun_earth_correction_esa:.9f} ; sza = {sza:.4f} deg")
 
@@ -121,73 +153,84 @@ class SpectralAggregation:
 
         return self._sun_earth_correction
 
+    def _read_cube(self, cube: str):
+        # Read cube bands (read, rotate, convert to radiance)
+        image_cube_radiance = read_cube_to_radiance(self._product_file, cube)
+        logger.info("%s %s bands processed (read, rotate, convert to radiance)", image_cube_radiance.shape[0], cube)
+        return image_cube_radiance
+
     def process(self):
         start_time = time.time()
 
-        # -----------------------------------------------------------------------------------------------
-        # Generation of spectral aggregation coefficients for PRISMA to Sentinel-2 MSI-A (based on Barry and al)
-        # -----------------------------------------------------------------------------------------------
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # -----------------------------------------------------------------------------------------------
+            # Read all PRISMA bands (VNIR & SWIR) and convert into radiance units (W.m-2.sr-1.um-1)
+            # -----------------------------------------------------------------------------------------------
+
+            # Both cube reads do not depend on aggregation coefficients,
+            # so they run concurrently while coefficients are generated or loaded
+            vnir_read = executor.submit(self._read_cube, "VNIR")
+            swir_read = executor.submit(self._read_cube, "SWIR")
 
-        self._generate_coefficients()
+            # -----------------------------------------------------------------------------------------------
+            # Generation of spectral aggregation coefficients for PRISMA to Sentinel-2 MSI-A (based on Barry and al)
+            # -----------------------------------------------------------------------------------------------
 
-        # -----------------------------------------------------------------------------------------------
-        # Read all PRISMA bands (VNIR & SWIR) and convert into radiance units (W.m-2.sr-1.um-1)
-        # -----------------------------------------------------------------------------------------------
+            self._generate_coefficients()
 
-        # Read VNIR bands (read, rotate, convert to radiance)
-        image_cube_vnir_radiance = read_cube_to_radiance(self._product_file, "VNIR")
-        logger.info("%s VNIR bands processed (read, rotate, convert to radiance)", image_cube_vnir_radiance.shape[2])
+            # -----------------------------------------------------------------------------------------------
+            # Perform spectral aggregation of PRISMA hyperspectral bands into S2A multi-spectral spectral bands
+            # -----------------------------------------------------------------------------------------------
 
-        # Read SWIR bands (read, rotate, convert to radiance)
-        image_cube_swir_radiance = read_cube_to_radiance(self._product_file, "SWIR")
-        logger.info("%s SWIR bands processed (read, rotate, convert to radiance)", image_cube_swir_radiance.shape[2])
+            image_cube_vnir_radiance = vnir_read.result()
 
-        logger.info("PRISMA VNIR and SWIR Cubes loaded")
+            # Image output properties (n_bands, n_lines, n_samples)
+            n_bands_s2 = 13
+            nl = image_cube_vnir_radiance.shape[1]
+            ns = image_cube_vnir_radiance.shape[2]
 
-        # -----------------------------------------------------------------------------------------------
-        # Perform spectral aggregation of PRISMA hyperspectral bands into S2A multi-spectral spectral bands
-        # -----------------------------------------------------------------------------------------------
+            # VNIR cube feeds S2 bands 0-9, SWIR cube S2 bands 10-12, both aggregated in the same S2 cube.
+            # VNIR aggregation overlaps the SWIR cube read if it is not finished yet
+            s2_toa_cube = np.empty((n_bands_s2, nl, ns), dtype=np.float32)
+            spectral_aggregation_prisma_s2(
+                image_cube_vnir_radiance, self._p_prisma_vnir[:, :, :10], out=s2_toa_cube[:10]
+            )
+            spectral_aggregation_prisma_s2(swir_read.result(), self._p_prisma_swir[:, :, 10:], out=s2_toa_cube[10:])
+
+        logger.info("PRISMA VNIR and SWIR cubes aggregated")
 
-        logger.info("Performing Aggregation and saving S2P radiance and reflectance files")
+        logger.info("Saving S2P %s files", "radiance and reflectance" if self._write_radiance else "reflectance")
 
         # Create output filenames
-        out_image_rad = os.path.join(self._work_dir, "S2P_image_cube_toa_radiance_v5.tif")
+        out_image_rad = None
+        if self._write_radiance:
+            out_image_rad = os.path.join(self._work_dir, "S2P_image_cube_toa_radiance_v5.tif")
         out_image_ref = os.path.join(self._work_dir, "S2P_image_cube_toa_reflectance_v5_esa.tif")
 
-        # Image output properties (n_samples, n_lines, n_bands)
-        ns = image_cube_vnir_radiance.shape[1]
-        nl = image_cube_vnir_radiance.shape[0]
-        n_bands_s2 = 13
+        # Radiance to reflectance factor of each S2 band: pi * d**2 / (esun * cos(sza))
+        cos_sza = math.cos(math.radians(self._product.sun_zenith_angle))
+        reflectance_factors = np.pi * self.sun_earth_distance**2 / (_ESUN * cos_sza)
 
-        # Create Geotiff
+        # Create Geotiff and write all bands at once
         driver = gdal.GetDriverByName("GTiff")
-        dest_ds_rad = driver.Create(out_image_rad, ns, nl, n_bands_s2, gdal.GDT_Float32)
-        dest_ds_ref = driver.Create(out_image_ref, ns, nl, n_bands_s2, gdal.GDT_Float32)
-
-        for b in range(n_bands_s2):
-            if b < 10:
-                prisma_s2_toa_radiance = spectral_aggregation_prisma_s2(
-                    image_cube_vnir_radiance, self._p_prisma_vnir, b
-                )
-
-            else:
-                prisma_s2_toa_radiance = spectral_aggregation_prisma_s2(
-                    image_cube_swir_radiance, self._p_prisma_swir, b
-                )
-
-            # Conversion from radiance (W.m-2.sr-1.um-1) to reflectance (unitless)
-            prisma_s2_toa_reflectance = radiance_to_reflectance(
-                prisma_s2_toa_radiance, _ESUN[b], self._product.sun_zenith_angle, self.sun_earth_distance
-            )
 
-            # Write TOA radiance band to multi-band raster file
-            dest_ds_rad.GetRasterBand(b + 1).WriteArray(prisma_s2_toa_radiance)
-
-            # Write TOA reflectance band to multi-band raster file
-            dest_ds_ref.GetRasterBand(b + 1).WriteArray(prisma_s2_toa_reflectance)
-
-        # Close properly the datasets
-        dest_ds_rad = None
+        if out_image_rad:
+            # Write TOA radiance cube to multi-band raster file
+            dest_ds_rad = driver.Create(
+                out_image_rad, ns, nl, n_bands_s2, gdal.GDT_Float32, options=S2P_CREATION_OPTIONS
+            )
+            dest_ds_rad.WriteArray(s2_toa_cube)
+            # Close properly the dataset
+            dest_ds_rad = None
+
+        # Conversion from radiance (W.m-2.sr-1.um-1) to reflectance (unitless),
+        # done in place as radiance cube is not used anymore
+        radiance_to_reflectance(s2_toa_cube, reflectance_factors[:, np.newaxis, np.newaxis], out=s2_toa_cube)
+
+        # Write TOA reflectance cube to multi-band raster file
+        dest_ds_ref = driver.Create(out_image_ref, ns, nl, n_bands_s2, gdal.GDT_Float32, options=S2P_CREATION_OPTIONS)
+        dest_ds_ref.WriteArray(s2_toa_cube)
+        # Close properly the dataset
         dest_ds_ref = None
 
         logger.info("Spectral Aggregation done")
@@ -195,7 +238,8 @@ class SpectralAggregation:
         total_processing_time = time.time() - start_time
 
         logger.info("Total processing time: %.3f seconds", total_processing_time)
-        logger.info("Radiance image : %s", out_image_rad)
+        if out_image_rad:
+            logger.info("Radiance image : %s", out_image_rad)
         logger.info("Reflectance image : %s", out_image_ref)
         logger.info("Finished")
 
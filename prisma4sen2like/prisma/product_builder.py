@@ -93,12 +93,18 @@ Example:
 MTD_MSIL1C
 TODO
 """
+import errno
 import logging
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property
 
+import numpy as np
 from adapter import MaskFileDef
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import Environment, FileSystemLoader
+from numpy.typing import NDArray
 from osgeo import gdal
 from sen2like_product import BAND_LIST, MASK_TABLE, Sen2LikeProduct
 from utils import utc_format
@@ -106,16 +112,56 @@ from utils import utc_format
 logger = logging.getLogger(__name__)
 
 
+def _scale_to_byte(array: NDArray, src_min: float, src_max: float, dst_min: int, dst_max: int) -> NDArray:
+    """Linearly scale array values from [src_min, src_max] to [dst_min, dst_max] into a byte array.
+    Values are rounded to the nearest integer and clamped to byte range, as GDAL does with scale params
+
+    Args:
+        array (NDArray): array to scale
+        src_min (float): source value mapped to dst_min
+        src_max (float): source value mapped to dst_max
+        dst_min (int): destination min value
+        dst_max (int): destination max value
+
+    Returns:
+        NDArray: scaled byte array
+    """
+    scaled = array.astype(np.float32)
+    scaled -= src_min
+    scaled *= (dst_max - dst_min) / (src_max - src_min)
+    scaled += dst_min + 0.5
+    np.floor(scaled, out=scaled)
+    np.clip(scaled, 0, 255, out=scaled)
+    return scaled.astype(np.uint8)
+
+
+@dataclass
+class QuicklookOutput:
+    """Quicklook output file definition"""
+
+    path: str
+    x_res: float
+    y_res: float
+
+
 class Sen2LikeProductBuilder:
     """Class to build/package a Sentinel 2 L1 like product"""
 
     _TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "product_template")
 
+    # Shared by all builders so that templates are parsed once per process (kept in environment cache).
+    # Templates are shipped with the code, so no need to check them for update.
+    # They are all XML, escaping is always on rather than selected from each template name
+    _ENV = Environment(
+        loader=FileSystemLoader(_TEMPLATE_DIR),
+        autoescape=True,
+        auto_reload=False,
+    )
+
     def __init__(self, product: Sen2LikeProduct, work_dir: str, dest_dir: str):
         self._product: Sen2LikeProduct = product
         self._product_dir = os.path.join(work_dir, self._product.product_name)
         self._dest_dir = dest_dir
-        self._env = Environment(loader=FileSystemLoader(self._TEMPLATE_DIR), autoescape=select_autoescape())
         self._created_masks: list[MaskFileDef] = []
 
     def build(self):
@@ -127,6 +173,7 @@ class Sen2LikeProductBuilder:
         self._create_mask_files()
 
         # images files
+        self._product.prefetch_band_files(BAND_LIST)
         self._create_pvi_file()
         self._create_band_images_file()
 
@@ -137,51 +184,58 @@ class Sen2LikeProductBuilder:
 
         # finally put in destination dir
         dest_dir = os.path.join(self._dest_dir, self._product.product_name)
-        os.rename(self._product_dir, dest_dir)
+        try:
+            os.replace(self._product_dir, dest_dir)
+        except OSError as error:
+            # working and destination dirs are not on the same file system
+            if error.errno != errno.EXDEV:
+                raise
+            self._move_tree(self._product_dir, dest_dir)
 
         logger.info("Product available in %s", dest_dir)
 
     # ####################
     # PATH Properties
+    # product identifiers do not change, paths are computed once
 
-    @property
+    @cached_property
     def _aux_path(self):
         return os.path.join(self._product_dir, "AUX_DATA")
 
-    @property
+    @cached_property
     def _datastrip_path(self):
         return os.path.join(self._product_dir, "DATASTRIP", self._product.datastrip_identifier[17:56])
 
-    @property
+    @cached_property
     def _datastrip_qi_data_path(self):
         return os.path.join(self._datastrip_path, "QI_DATA")
 
-    @property
+    @cached_property
     def _html_path(self):
         return os.path.join(self._product_dir, "HTML")
 
-    @property
+    @cached_property
     def _rep_info_path(self):
         return os.path.join(self._product_dir, "rep_info")
 
-    @property
+    @cached_property
     def _granule_path(self):
         return os.path.join(self._product_dir, "GRANULE", self._product.short_granule_identifier)
 
-    @property
+    @cached_property
     def _granule_aux_data_path(self):
         return os.path.join(self._granule_path, "AUX_DATA")
 
-    @property
+    @cached_property
     def _granule_img_data_path(self):
         return os.path.join(self._granule_path, "IMG_DATA")
 
-    @property
+    @cached_property
     def _relative_granule_qi_data_path(self):
         # Warning: this function is only for metadata template usage and not for file manipulation
         return "/".join(["GRANULE", self._product.short_granule_identifier, "QI_DATA"])
 
-    @property
+    @cached_property
     def _granule_qi_data_path(self):
         return os.path.join(self._granule_path, "QI_DATA")
 
@@ -190,23 +244,20 @@ class Sen2LikeProductBuilder:
 
     def _create_product_structure(self):
         logger.info("Create product folder tree in %s", self._product_dir)
-        # product root
-        os.mkdir(self._product_dir)
-
-        # inside product
-        os.mkdir(self._aux_path)
-        os.mkdir(self._html_path)
-        os.mkdir(self._rep_info_path)
-
-        # datastrip dir
-        os.makedirs(self._datastrip_path)
-        os.mkdir(self._datastrip_qi_data_path)
-
-        # granule dir
-        os.makedirs(self._granule_path)
-        os.mkdir(self._granule_aux_data_path)
-        os.mkdir(self._granule_img_data_path)
-        os.mkdir(self._granule_qi_data_path)
+        # only create leaf folders, product root, datastrip and granule dirs are created with them
+        for leaf_path in (
+            # inside product
+            self._aux_path,
+            self._html_path,
+            self._rep_info_path,
+            # datastrip dir
+            self._datastrip_qi_data_path,
+            # granule dir
+            self._granule_aux_data_path,
+            self._granule_img_data_path,
+            self._granule_qi_data_path,
+        ):
+            os.makedirs(leaf_path)
 
         # add static file
         shutil.copy(
@@ -224,26 +275,19 @@ class Sen2LikeProductBuilder:
         for band in band_list:
             images[band] = self._product.get_band_file(band)
 
-        result_path = self.quicklook(
-            images,
-            band_list,
-            tci_file_path,
-            95,
-            xRes=30,
-            yRes=30,
-            creationOptions=["COMPRESS=LZW"],
-            out_format="GTIFF",
-            offset=1000,
-        )
-
-        result_path = self.quicklook(
+        # TCI and PVI are generated from the same RGB source in a single quicklook call
+        result_paths = self.quicklook(
             images,
             band_list,
-            pvi_file_path,
+            [QuicklookOutput(tci_file_path, 30, 30), QuicklookOutput(pvi_file_path, 320, 320)],
             95,
-            xRes=320,
-            yRes=320,
-            creationOptions=["COMPRESS=LZW"],
+            creationOptions=[
+                "COMPRESS=DEFLATE",
+                "NUM_THREADS=ALL_CPUS",
+                "TILED=YES",
+                "BLOCKXSIZE=256",
+                "BLOCKYSIZE=256",
+            ],
             out_format="GTIFF",
             offset=1000,
         )
@@ -256,10 +300,8 @@ class Sen2LikeProductBuilder:
         self,
         images,
         bands,
-        qlpath,
+        outputs: list[QuicklookOutput],
         quality=95,
-        xRes=30,
-        yRes=30,
         out_format="JPEG",
         creationOptions: list = None,
         offset: int = 0,
@@ -268,8 +310,8 @@ class Sen2LikeProductBuilder:
 
         :param images: list of image filepaths
         :param bands: List of 3 band index for [R, G, B]
-        :param qlpath: output file path
-        :return: output file path if any otherwise None
+        :param outputs: output files definitions (path and resolution), all generated from the same source
+        :return: output file paths if any otherwise None
         """
 
         imagefiles = []
@@ -280,12 +322,14 @@ class Sen2LikeProductBuilder:
                 logger.warning("Bands not available for quicklook (%s)", bands)
                 return None
             else:
-                imagefiles.append(images[band])
+                # absolute path, sources cannot be relative to the in memory vrt
+                imagefiles.append(os.path.abspath(images[band]))
 
-        # create output directory if it does not exist
-        qldir = os.path.dirname(qlpath)
-        if not os.path.exists(qldir):
-            os.makedirs(qldir)
+        # create output directories if they do not exist
+        for output in outputs:
+            qldir = os.path.dirname(output.path)
+            if not os.path.exists(qldir):
+                os.makedirs(qldir)
 
         # Grayscale or RGB
         if len(bands) == 1:
@@ -293,16 +337,18 @@ class Sen2LikeProductBuilder:
         else:
             band_list = [1, 2, 3]
 
-        # create single vrt with B4 B3 B2
-        vrtpath = qlpath + ".vrt"
+        # create single in memory vrt with B4 B3 B2, without nodata attribute
+        vrtpath = f"/vsimem/{os.path.basename(outputs[0].path)}.vrt"
+        vrt = gdal.BuildVRT(vrtpath, imagefiles, separate=True, srcNodata="none", VRTNodata="none")
+        del vrt
 
-        gdal.BuildVRT(vrtpath, imagefiles, separate=True)
+        # When several outputs are requested, decode source images once in memory
+        # and generate all outputs from this decoded source
+        srcpath = vrtpath
+        if len(outputs) > 1:
+            srcpath = f"/vsimem/{os.path.basename(vrtpath)}.tif"
+            gdal.Translate(srcpath, vrtpath, format="GTiff")
 
-        # Remove nodata attribut
-        vrt = gdal.Open(vrtpath, gdal.GA_Update)
-        for i in band_list:
-            vrt.GetRasterBand(i).DeleteNoDataValue()
-        del vrt
         # convert to JPEG (with scaling)
         # TODO: DN depend on the mission, the level of processing...
 
@@ -316,8 +362,6 @@ class Sen2LikeProductBuilder:
         if bands == ["B12", "B11", "B8A"]:
             src_max = 4000
 
-        scale = [[src_min + offset, src_max + offset, dst_min, dst_max]]
-
         # do gdal...
         if out_format == "GTIFF":
             # Because the driver does not support QUALITY={quality} as create_options when format='Gtiff'
@@ -327,72 +371,109 @@ class Sen2LikeProductBuilder:
                 [f"QUALITY={quality}"] if creationOptions is None else [f"QUALITY={quality}"] + creationOptions
             )
 
-        dataset = gdal.Translate(
-            qlpath,
-            vrtpath,
-            xRes=xRes,
-            yRes=yRes,
-            resampleAlg="bilinear",
-            bandList=band_list,
-            outputType=gdal.GDT_Byte,
-            format=out_format,
-            creationOptions=create_options,
-            scaleParams=scale,
-        )
-
         quantification_value = 10000.0
         scaling = (src_max - src_min) / quantification_value / (dst_max - dst_min)
 
-        try:
-            for i in band_list:
-                dataset.GetRasterBand(i).SetScale(scaling)
-                # force offset to 0
-                dataset.GetRasterBand(i).SetOffset(0)
-                dataset.GetRasterBand(i).DeleteNoDataValue()
+        for output in outputs:
+            # resample source at output resolution, then scale it to byte with numpy
+            resampled = gdal.Translate(
+                "",
+                srcpath,
+                xRes=output.x_res,
+                yRes=output.y_res,
+                resampleAlg="bilinear",
+                bandList=band_list,
+                format="MEM",
+            )
+            scaled = _scale_to_byte(resampled.ReadAsArray(), src_min + offset, src_max + offset, dst_min, dst_max)
 
-            dataset = None
+            mem_dataset = gdal.GetDriverByName("MEM").Create(
+                "", resampled.RasterXSize, resampled.RasterYSize, len(band_list), gdal.GDT_Byte
+            )
+            mem_dataset.SetGeoTransform(resampled.GetGeoTransform())
+            mem_dataset.SetProjection(resampled.GetProjection())
+            mem_dataset.WriteArray(scaled)
+            resampled = None
+
+            dataset = gdal.GetDriverByName(out_format).CreateCopy(output.path, mem_dataset, options=create_options)
+            mem_dataset = None
+
+            try:
+                for i in band_list:
+                    dataset.GetRasterBand(i).SetScale(scaling)
+                    # force offset to 0
+                    dataset.GetRasterBand(i).SetOffset(0)
+                    dataset.GetRasterBand(i).DeleteNoDataValue()
+
+                dataset = None
 
-        except Exception as e:
-            logger.warning(e, exc_info=True)
-            logger.warning("error updating the metadata of quicklook image")
+            except Exception as e:
+                logger.warning(e, exc_info=True)
+                logger.warning("error updating the metadata of quicklook image")
 
         # clean
-        os.remove(vrtpath)
+        if srcpath != vrtpath:
+            gdal.Unlink(srcpath)
+        gdal.Unlink(vrtpath)
 
-        return qlpath
+        return [output.path for output in outputs]
 
     def _create_band_images_file(self):
-        for band in BAND_LIST:
-            band_file = self._product.get_band_file(band)
-
-            shutil.copyfile(
-                band_file, os.path.join(self._granule_img_data_path, self._product.get_image_filename(band) + ".TIF")
-            )
+        self._copy_files(
+            [
+                (band_file, os.path.join(self._granule_img_data_path, image_filename + ".TIF"))
+                for band_file, image_filename in self._product.band_file_map.items()
+            ]
+        )
 
     def _create_mask_files(self):
         logger.info("Extract masks")
         # Get possible mask files, copy them to their dest dir,
         # then update _created_masks to properly fill for MTD_TL
-        for mask_file in MASK_TABLE:
+        mask_copies = []
+        for mask_file, mask_file_path in self._product.get_mask_files(MASK_TABLE).items():
             logger.info("Attempt to extract %s", mask_file.value)
-            mask_file_path = self._product.get_mask_file(mask_file)
             if mask_file_path:
-                shutil.copyfile(mask_file_path, os.path.join(self._granule_qi_data_path, mask_file.value))
+                mask_copies.append((mask_file_path, os.path.join(self._granule_qi_data_path, mask_file.value)))
                 self._created_masks.append(mask_file)
             else:
                 logger.warning("Unable to extract %s", mask_file.value)
 
+        self._copy_files(mask_copies)
+
+    @classmethod
+    def _move_tree(cls, src_dir: str, dest_dir: str):
+        # copy files of the tree concurrently, without metadata as they are freshly generated, then remove source
+        copies = []
+        for dir_path, _, file_names in os.walk(src_dir):
+            dest_path = os.path.join(dest_dir, os.path.relpath(dir_path, src_dir))
+            os.makedirs(dest_path)
+            copies.extend((os.path.join(dir_path, name), os.path.join(dest_path, name)) for name in file_names)
+
+        cls._copy_files(copies)
+        shutil.rmtree(src_dir)
+
+    @staticmethod
+    def _copy_files(copies: list[tuple[str, str]]):
+        # copies are independent I/O bound operations, run them concurrently
+        if not copies:
+            return
+        with ThreadPoolExecutor(max_workers=min(8, len(copies))) as executor:
+            # consume results to raise any copy error.
+            # copyfile uses in kernel copies (copy_file_range / sendfile, fcopyfile) where the OS has them
+            list(executor.map(lambda copy: shutil.copyfile(*copy), copies))
+
     def _render_product_mtd(self):
         logger.info("Render MTD_MSIL1C.xml")
 
-        template = self._env.get_template("MTD_MSIL1C.xml")
+        template = self._ENV.get_template("MTD_MSIL1C.xml")
 
         output_from_parsed_template = template.render(
             product=self._product,
             product_start=utc_format(self._product.product_start_time),
             product_stop=utc_format(self._product.product_stop_time),
             datatake_sensing_start=utc_format(self._product.datatake_sensing_start),
-            generation_time=self._product.product_date.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            generation_time=f"{self._product.product_date.replace(tzinfo=None).isoformat(timespec='microseconds')}Z",
         )
 
         # to save the results
@@ -416,7 +497,7 @@ class Sen2LikeProductBuilder:
 
         logger.info("Render MTD_DS.xml")
 
-        template = self._env.get_template("DATASTRIP/DS_ID/MTD_DS.xml")
+        template = self._ENV.get_template("DATASTRIP/DS_ID/MTD_DS.xml")
 
         output_from_parsed_template = template.render(
             product=self._product,
@@ -425,7 +506,7 @@ class Sen2LikeProductBuilder:
             datatake_sensing_start=utc_format(self._product.datatake_sensing_start),
             datastrip_sensing_start=utc_format(self._product.datastrip_sensing_start),
             datastrip_sensing_stop=utc_format(self._product.datastrip_sensing_stop),
-            processing_time=self._product.processing_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            processing_time=f"{self._product.processing_time.replace(tzinfo=None).isoformat(timespec='seconds')}Z",
         )
 
         # to save the results
@@ -451,11 +532,11 @@ class Sen2LikeProductBuilder:
 
         logger.info("Render MTD_TL.xml")
 
-        template = self._env.get_template("GRANULE/TL_ID/MTD_TL.xml")
+        template = self._ENV.get_template("GRANULE/TL_ID/MTD_TL.xml")
 
         output_from_parsed_template = template.render(
             product=self._product,
-            sensing_time=self._product.tile_sensing_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            sensing_time=f"{self._product.tile_sensing_time.replace(tzinfo=None).isoformat(timespec='microseconds')}Z",
             granule_qi_path=self._relative_granule_qi_data_path,
             mask_files=self._created_masks,
         )
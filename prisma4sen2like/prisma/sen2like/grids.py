@@ -2,13 +2,15 @@
 # -*- coding: utf-8 -*-
 # V. Debaecker (TPZ-F) 2018
 
+import json
 import os
 import sqlite3
+import threading
 from dataclasses import dataclass
 from os.path import dirname
+from pathlib import Path
 
 import mgrs
-import pandas as pd
 from osgeo import ogr, osr
 from shapely.geometry.base import BaseGeometry
 
@@ -16,6 +18,32 @@ current_dir = dirname(__file__)
 DB_file = os.path.join(current_dir, "s2tiles.db")
 
 
+# tiles db connections, one per thread as a sqlite connection must not be used concurrently
+_thread_data = threading.local()
+
+
+def _thread_connection() -> sqlite3.Connection:
+    # tiles db is only read: a read-only connection is opened once per thread and shared
+    # by the converters of this thread, and SQLite maps the db in memory
+    conn = getattr(_thread_data, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(f"{Path(os.path.abspath(DB_file)).as_uri()}?mode=ro", uri=True)
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute("PRAGMA mmap_size=268435456")
+        _thread_data.conn = conn
+    return conn
+
+
+def close_connection():
+    """Close the tiles db connection of the current thread, if any.
+    Next converter created in this thread opens a new one.
+    """
+    conn = getattr(_thread_data, "conn", None)
+    if conn is not None:
+        _thread_data.conn = None
+        conn.close()
+
+
 @dataclass
 class MGRSGeoInfo:
     """MGRS tile geo info"""
@@ -35,27 +63,26 @@ class GridsConverter:
     """
 
     def __init__(self):
-        self.conn = sqlite3.connect(DB_file)
+        self.conn = _thread_connection()
 
     def _get_roi(self, tilecode):
-        # search tilecode in "s2tiles" and return row as a pandas dataframe
-        return pd.read_sql_query(
-            f'SELECT TILE_ID, EPSG, UTM_WKT, MGRS_REF, LL_WKT FROM s2tiles WHERE TILE_ID="{tilecode}"',  # nosec B608
-            self.conn,
+        # search tilecode in "s2tiles" and return row as a dict of single value lists (empty if not found)
+        cursor = self.conn.execute(
+            "SELECT TILE_ID, EPSG, UTM_WKT, MGRS_REF, LL_WKT FROM s2tiles WHERE TILE_ID=?", (tilecode,)
         )
+        row = cursor.fetchone()
+        return {column[0]: [] if row is None else [row[i]] for i, column in enumerate(cursor.description)}
 
     def close(self):
-        self.conn.close()
+        # release the connection, it stays open for next converters of the thread, see close_connection
+        self.conn = None
 
     def getROIfromMGRS(self, tilecode):
         # read db and get "sites" table
         if tilecode.startswith("T"):
             tilecode = tilecode[1:]
 
-        roi = self._get_roi(tilecode)
-
-        # return as dict
-        return roi.to_dict(orient="list")
+        return self._get_roi(tilecode)
 
     def get_mgrs_center(self, tilecode, utm=False):
         if tilecode.startswith("T"):
@@ -105,16 +132,14 @@ class GridsConverter:
 
     # Manual export...
     def wktToJson(self, wkt, epsg_code, filename):
-        # polygon from wkt, to geojson string
+        # polygon from wkt, to geojson geometry
         multipolygon = ogr.CreateGeometryFromWkt(wkt)
-        geojson = multipolygon.ExportToJson()
+        geometry = json.loads(multipolygon.ExportToJson())
 
-        param = "{\n"
-        param += '"type": "FeatureCollection",\n'
-        param += '"crs": { "type": "name", "properties": { "name": "urn:ogc:def:crs:EPSG::' + epsg_code + '" } },\n'
-        param += '"features": [\n'
-        param += '{ "type": "Feature", "properties": { "prop0": null }, "geometry":'
+        feature_collection = {
+            "type": "FeatureCollection",
+            "crs": {"type": "name", "properties": {"name": f"urn:ogc:def:crs:EPSG::{epsg_code}"}},
+            "features": [{"type": "Feature", "properties": {"prop0": None}, "geometry": geometry}],
+        }
 
-        with open(filename, "w", encoding="UTF-8") as f:
-            f.write(param)
-            f.write(geojson + "}]}")
+        Path(filename).write_text(json.dumps(feature_collection, separators=(",", ":")), encoding="UTF-8")
@@ -5,12 +5,119 @@
 
 import logging
 import os
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
 
 import numpy as np
-from osgeo import gdal, osr
+from osgeo import gdal, gdal_array, osr
 
 log = logging.getLogger(__name__)
 
+# drivers are looked up once
+_GTIFF_DRIVER = gdal.GetDriverByName("GTiff")
+_MEM_DRIVER = gdal.GetDriverByName("MEM")
+_JP2_DRIVER = gdal.GetDriverByName("JP2OpenJPEG")
+
+# GDAL data type of array dtypes, by name as GDAL knows them (depends on its version)
+_GDAL_TYPE_BY_DTYPE = {
+    np.dtype(name): gdal.GetDataTypeByName(name)
+    for name in ("uint16", "int16", "uint32", "int32", "uint64", "int64", "float32", "float64")
+}
+# work around to GDT_Unknown for 8 bits integers
+_GDAL_TYPE_BY_DTYPE.update({np.dtype(np.uint8): gdal.GDT_Byte, np.dtype(np.int8): gdal.GDT_Byte})
+
+_FLOAT_DTYPES = frozenset((np.dtype(np.float16), np.dtype(np.float32), np.dtype(np.float64)))
+
+# JPEG2000 creation options by resolution, overriding given ones
+_JP2_OPTIONS_BY_RES = {
+    60: {
+        "CODEBLOCK_WIDTH": "4",
+        "CODEBLOCK_HEIGHT": "4",
+        "BLOCKXSIZE": "192",
+        "BLOCKYSIZE": "192",
+        "PROGRESSION": "LRCP",
+        "PRECINCTS": "{64,64},{64,64},{64,64},{64,64},{64,64},{64,64}",
+    },
+    20: {
+        "CODEBLOCK_WIDTH": "8",
+        "CODEBLOCK_HEIGHT": "8",
+        "BLOCKXSIZE": "640",
+        "BLOCKYSIZE": "640",
+        "PROGRESSION": "LRCP",
+        "PRECINCTS": "{128,128},{128,128},{128,128},{128,128},{128,128},{128,128}",
+    },
+    10: {
+        "CODEBLOCK_WIDTH": "64",
+        "CODEBLOCK_HEIGHT": "64",
+        "BLOCKXSIZE": "1024",
+        "BLOCKYSIZE": "1024",
+        "PROGRESSION": "LRCP",
+        "PRECINCTS": "{256,256},{256,256},{256,256},{256,256},{256,256},{256,256}",
+    },
+}
+
+
+def _scale_to_uint16(array, gain, offset, nodata_value, scratch=None):
+    """Convert a float array to UInt16 as 'clip(min=0) * gain + offset', NaN being set to nodata_value.
+    Scaling is done in place in a single float buffer to limit full size temporaries.
+    This buffer is 'scratch' if given (same shape and dtype as array), so that it can be reused between calls.
+    """
+    # maximum and not fmax: NaN must be kept to be set to no data
+    scaled = np.maximum(array, 0, out=scratch)
+    scaled *= gain
+    scaled += offset
+
+    # NaN are kept by scaling, set no data in the float buffer so that the cast produces the final output
+    nan_mask = np.isnan(scaled)
+    if nan_mask.any():
+        np.copyto(scaled, nodata_value, where=nan_mask)
+    return scaled.astype(np.uint16)
+
+
+def _to_gdal_options(options):
+    """Convert an options dict to GDAL "KEY=VALUE" list"""
+    return [f"{key}={value}" for key, value in options.items()]
+
+
+@contextmanager
+def _thread_local_config_option(key, value):
+    """Set a GDAL config option for the current thread only, restoring its previous value on exit"""
+    previous = gdal.GetThreadLocalConfigOption(key, None)
+    gdal.SetThreadLocalConfigOption(key, value)
+    try:
+        yield
+    finally:
+        gdal.SetThreadLocalConfigOption(key, previous)
+
+
+@lru_cache(maxsize=32)
+def _wkt_for_epsg(epsg_code):
+    """WKT of an EPSG code, the EPSG database is only queried once per code"""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg_code)
+    return srs.ExportToWkt()
+
+
+@lru_cache(maxsize=64)
+def _get_transform(in_wkt, out_wkt=None, out_epsg=None, out_proj4=None):
+    """Coordinate transformation from in_wkt to the output projection given as WKT, EPSG or PROJ4 (first set).
+    Transformations are cached, images of a product share the same projections.
+    """
+    if out_wkt is not None:
+        out_sr = osr.SpatialReference(wkt=out_wkt)
+    elif out_epsg is not None:
+        out_sr = osr.SpatialReference()
+        out_sr.ImportFromEPSG(int(out_epsg))
+    else:
+        out_sr = osr.SpatialReference()
+        out_sr.ImportFromProj4(out_proj4)
+
+    in_sr = osr.SpatialReference(wkt=in_wkt)
+    if hasattr(out_sr, "SetAxisMappingStrategy"):
+        out_sr.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(in_sr, out_sr)
+
 
 class S2L_ImageFile:
     FILE_EXTENSIONS = {
@@ -20,6 +127,7 @@ class S2L_ImageFile:
     }
 
     def __init__(self, path, mode="r"):
+        self._dst_lock = threading.Lock()
         self.setFilePath(path)
 
         # geo information
@@ -46,6 +154,8 @@ class S2L_ImageFile:
         self.rootname, self.ext = os.path.splitext(self.filename)
         self.dirpath = os.path.dirname(path)
         self.dirname = os.path.basename(self.dirpath)
+        # opened dataset of the file, see _dataset property
+        self._dst = None
 
     @property
     def array(self):
@@ -56,9 +166,36 @@ class S2L_ImageFile:
             self.read()
         return self._array
 
+    @property
+    def _dataset(self):
+        """File dataset, opened only once and shared by readHeader, read and crop"""
+        with self._dst_lock:
+            if self._dst is None:
+                # raster only, vector drivers are not probed.
+                # Image files are intermediates generated without sidecar files, do not list their folder
+                with _thread_local_config_option("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR"):
+                    self._dst = gdal.OpenEx(self.filepath, gdal.OF_RASTER | gdal.OF_READONLY)
+            return self._dst
+
+    def close(self):
+        """Release the opened file dataset, if any"""
+        with self._dst_lock:
+            self._dst = None
+
+    def __getstate__(self):
+        # neither the lock nor the GDAL dataset can be pickled, dataset is reopened on demand
+        state = self.__dict__.copy()
+        del state["_dst_lock"]
+        state["_dst"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._dst_lock = threading.Lock()
+
     def readHeader(self):
         # geo information
-        dst = gdal.Open(self.filepath)
+        dst = self._dataset
         geo = dst.GetGeoTransform()
         self.xSize = dst.RasterXSize
         self.ySize = dst.RasterYSize
@@ -69,7 +206,6 @@ class S2L_ImageFile:
         self.xMax = self.xMin + self.xSize * self.xRes
         self.yMin = self.yMax + self.ySize * self.yRes
         self.projection = dst.GetProjection()
-        dst = None
 
     def copyHeaderTo(self, new):
         # geo information
@@ -103,26 +239,12 @@ class S2L_ImageFile:
         Source: rios library
 
         """
-        if outWKT is not None:
-            outSR = osr.SpatialReference(wkt=outWKT)
-        elif outEPSG is not None:
-            outSR = osr.SpatialReference()
-            outSR.ImportFromEPSG(int(outEPSG))
-        elif outPROJ4 is not None:
-            outSR = osr.SpatialReference()
-            outSR.ImportFromProj4(outPROJ4)
-        else:
-            outSR = None
-
-        if outSR is not None:
-            inSR = osr.SpatialReference(wkt=self.projection)
-            if hasattr(outSR, "SetAxisMappingStrategy"):
-                outSR.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
-            t = osr.CoordinateTransformation(inSR, outSR)
-            (ul_x, ul_y, z) = t.TransformPoint(self.xMin, self.yMax)
-            (ll_x, ll_y, z) = t.TransformPoint(self.xMin, self.yMin)
-            (ur_x, ur_y, z) = t.TransformPoint(self.xMax, self.yMax)
-            (lr_x, lr_y, z) = t.TransformPoint(self.xMax, self.yMin)
+        if outWKT is not None or outEPSG is not None or outPROJ4 is not None:
+            t = _get_transform(self.projection, outWKT, outEPSG, outPROJ4)
+            # all corners in a single call
+            ((ul_x, ul_y, _), (ll_x, ll_y, _), (ur_x, ur_y, _), (lr_x, lr_y, _)) = t.TransformPoints(
+                [(self.xMin, self.yMax), (self.xMin, self.yMin), (self.xMax, self.yMax), (self.xMax, self.yMin)]
+            )
         else:
             (ul_x, ul_y) = (self.xMin, self.yMax)
             (ll_x, ll_y) = (self.xMin, self.yMin)
@@ -132,10 +254,8 @@ class S2L_ImageFile:
         return ul_x, ul_y, ur_x, ur_y, lr_x, lr_y, ll_x, ll_y
 
     def read(self):
-        dst = gdal.Open(self.filepath)
-        band = dst.GetRasterBand(1)
+        band = self._dataset.GetRasterBand(1)
         self._array = band.ReadAsArray()
-        dst = None
 
     def crop(self, box):
         """
@@ -148,11 +268,8 @@ class S2L_ImageFile:
         xoff, yoff, win_xsize, win_ysize = box
 
         # read
-        dst = gdal.Open(self.filepath)
-        band = dst.GetRasterBand(1)
-        data = band.ReadAsArray(xoff, yoff, win_xsize, win_ysize)
-        dst = None
-        return data
+        band = self._dataset.GetRasterBand(1)
+        return band.ReadAsArray(xoff, yoff, win_xsize, win_ysize)
 
     def duplicate(self, filepath, array=None, res=None, origin=None, output_EPSG=None) -> "S2L_ImageFile":
         # case array is not provided (default)
@@ -180,9 +297,7 @@ class S2L_ImageFile:
             new_image.yMin = new_image.yMax + new_image.ySize * new_image.yRes
 
         if output_EPSG is not None:
-            new_srs = osr.SpatialReference()
-            new_srs.ImportFromEPSG(int(output_EPSG))
-            new_image.projection = new_srs.ExportToWkt()
+            new_image.projection = _wkt_for_epsg(int(output_EPSG))
 
         #  data
         new_image._array = array
@@ -208,7 +323,7 @@ class S2L_ImageFile:
     ):
         """
         write to file
-        :param creation_options: gdal create options
+        :param creation_options: gdal create options, as a dict or a list of "KEY=VALUE"
         :param DCmode: if true, the type is kept. Otherwise float are converted to int16 using
         offset and gain from config
         :param filepath:
@@ -219,118 +334,97 @@ class S2L_ImageFile:
                             set to nodata_value all mask value, and increase by 1 all other value equal with
                             nodata_value.
         """
+        # creation options are handled as a dict, converted to GDAL list only when given to a driver
         if creation_options is None:
-            creation_options = []
+            creation_options = {}
+        elif isinstance(creation_options, dict):
+            creation_options = dict(creation_options)
+        else:
+            creation_options = dict(option.split("=", 1) for option in creation_options)
 
         # if filepath is override
         if filepath is None:
             filepath = self.filepath
 
-        # Ensure file extension
-        if not filepath.upper().endswith(self.FILE_EXTENSIONS[output_format]):
-            filepath = os.path.splitext(filepath)[0] + "." + self.FILE_EXTENSIONS[output_format]
-
-        # check if directory to create
-        if not os.path.exists(self.dirpath):
-            os.makedirs(self.dirpath)
+        # Ensure file extension, whatever its case
+        file_root, file_ext = os.path.splitext(filepath)
+        if file_ext[1:].lower() != self.FILE_EXTENSIONS[output_format].lower():
+            filepath = file_root + "." + self.FILE_EXTENSIONS[output_format]
 
-        # write with gdal
-        e_type = gdal.GetDataTypeByName(self.array.dtype.name)
-        if self.array.dtype.name.endswith("int8"):
-            # work around to GDT_Unknown
-            e_type = 1
-        elif "float" in self.array.dtype.name and not DCmode:
-            # float to UInt16
-            e_type = gdal.GDT_UInt16
+        # write with gdal, float to UInt16 unless DCmode
+        to_uint16 = self.array.dtype in _FLOAT_DTYPES and not DCmode
+        e_type = gdal.GDT_UInt16 if to_uint16 else _GDAL_TYPE_BY_DTYPE.get(self.array.dtype, gdal.GDT_Unknown)
 
+        # Release the dataset opened on the current file, it can be the one replaced
+        self.close()
         # Update image attributes
         self.setFilePath(filepath)
 
         # Create folders hierarchy if needed:
-        if not os.path.exists(self.dirpath):
-            os.makedirs(self.dirpath)
+        os.makedirs(self.dirpath, exist_ok=True)
 
+        # float to UInt16 with scaling factor of 10000
+        gain = 10000.0
+        offset = 1000.0
+
+        array_written = False
         if output_format == "GTIFF":
-            driver = gdal.GetDriverByName("GTiff")
-            dst_ds = driver.Create(
-                self.filepath, xsize=self.xSize, ysize=self.ySize, bands=1, eType=e_type, options=creation_options
+            dst_ds = _GTIFF_DRIVER.Create(
+                self.filepath,
+                xsize=self.xSize,
+                ysize=self.ySize,
+                bands=1,
+                eType=e_type,
+                options=_to_gdal_options(creation_options),
             )
         else:
-            driver = gdal.GetDriverByName("MEM")
-            dst_ds = driver.Create("", xsize=self.xSize, ysize=self.ySize, bands=1, eType=e_type)
+            # Final file is a copy of an in memory dataset. When possible, this dataset wraps
+            # the (converted) array instead of allocating and filling the whole raster again
+            mem_array = _scale_to_uint16(self.array, gain, offset, nodata_value) if to_uint16 else self.array
+            if gdal_array.NumericTypeCodeToGDALTypeCode(mem_array.dtype) == e_type:
+                dst_ds = gdal_array.OpenArray(mem_array)
+                array_written = True
+            else:
+                dst_ds = _MEM_DRIVER.Create("", xsize=self.xSize, ysize=self.ySize, bands=1, eType=e_type)
 
         dst_ds.SetProjection(self.projection)
         geo_transform = (self.xMin, self.xRes, 0, self.yMax, 0, self.yRes)
         log.debug(geo_transform)
         dst_ds.SetGeoTransform(geo_transform)
 
-        if "float" in self.array.dtype.name and not DCmode:
-            # float to UInt16 with scaling factor of 10000
-            gain = 10000.0
-            offset = 1000.0
-
-            array_out = (self.array.clip(min=0) * gain + offset).astype(np.uint16)
-
-            # set no data to zero
-            array_out[np.isnan(self.array)] = nodata_value
-
-            dst_ds.GetRasterBand(1).WriteArray(array_out)
+        if to_uint16:
+            if not array_written:
+                # convert and write by stripes of whole blocks (at least 256 lines for stripped images),
+                # so that the UInt16 image is never fully materialized next to the float one
+                out_band = dst_ds.GetRasterBand(1)
+                block_ysize = out_band.GetBlockSize()[1]
+                stripe_ysize = block_ysize * max(1, 256 // block_ysize)
+                # float scaling buffer shared by all stripes
+                scratch = np.empty((min(stripe_ysize, self.ySize), self.xSize), dtype=self.array.dtype)
+                for y_off in range(0, self.ySize, stripe_ysize):
+                    stripe = self.array[y_off : y_off + stripe_ysize]
+                    array_out = _scale_to_uint16(stripe, gain, offset, nodata_value, scratch[: stripe.shape[0]])
+                    out_band.WriteArray(array_out, 0, y_off)
             # set GTiff metadata
             dst_ds.GetRasterBand(1).SetScale(1 / gain)
             dst_ds.GetRasterBand(1).SetOffset(-offset / gain)
-        else:
+        elif not array_written:
             dst_ds.GetRasterBand(1).WriteArray(self.array)
 
         if nodata_value is not None:
             dst_ds.GetRasterBand(1).SetNoDataValue(nodata_value)
 
         if output_format == "JPEG2000":
-            driver_JPG = gdal.GetDriverByName("JP2OpenJPEG")
-
             # Overloading creation options
-            creation_options = dict(map(lambda o: o.split("="), creation_options))
             if S2L_config.config.getboolean("lossless_jpeg2000"):
                 creation_options["QUALITY"] = 100
                 creation_options["REVERSIBLE"] = "YES"
                 creation_options["YCBCR420"] = "NO"
 
-            if self.xRes == 60:
-                creation_options.update(
-                    {
-                        "CODEBLOCK_WIDTH": 4,
-                        "CODEBLOCK_HEIGHT": 4,
-                        "BLOCKXSIZE": 192,
-                        "BLOCKYSIZE": 192,
-                        "PROGRESSION": "LRCP",
-                        "PRECINCTS": "{64,64},{64,64},{64,64},{64,64},{64,64},{64,64}",
-                    }
-                )
-            elif self.xRes == 20:
-                creation_options.update(
-                    {
-                        "CODEBLOCK_WIDTH": 8,
-                        "CODEBLOCK_HEIGHT": 8,
-                        "BLOCKXSIZE": 640,
-                        "BLOCKYSIZE": 640,
-                        "PROGRESSION": "LRCP",
-                        "PRECINCTS": "{128,128},{128,128},{128,128},{128,128},{128,128},{128,128}",
-                    }
-                )
-            elif self.xRes == 10:
-                creation_options.update(
-                    {
-                        "CODEBLOCK_WIDTH": 64,
-                        "CODEBLOCK_HEIGHT": 64,
-                        "BLOCKXSIZE": 1024,
-                        "BLOCKYSIZE": 1024,
-                        "PROGRESSION": "LRCP",
-                        "PRECINCTS": "{256,256},{256,256},{256,256},{256,256},{256,256},{256,256}",
-                    }
-                )
-            creation_options = list(map(lambda ops: ops[0] + "=" + str(ops[1]), creation_options.items()))
+            creation_options.update(_JP2_OPTIONS_BY_RES.get(self.xRes, {}))
 
             # pylint: disable=unused-variable
-            data_set2 = driver_JPG.CreateCopy(self.filepath, dst_ds, options=creation_options)
+            data_set2 = _JP2_DRIVER.CreateCopy(self.filepath, dst_ds, options=_to_gdal_options(creation_options))
             # this is the way to close gdal dataset
             data_set2 = None
 
@@ -346,7 +440,6 @@ class S2L_ImageFile:
             downsampling_levels = [int(x) for x in downsampling_levels.split(" ")]
 
             # Overloading creation options
-            creation_options = dict(map(lambda o: o.split("="), creation_options))
             creation_options.update(
                 {
                     "TILED": "YES",
@@ -357,17 +450,15 @@ class S2L_ImageFile:
                     "PREDICTOR": str(S2L_config.config.get("predictor")),
                 }
             )
-            creation_options = list(map(lambda ops: ops[0] + "=" + str(ops[1]), creation_options.items()))
             # FIXME : in this gdal version, driver GTiff does not support creation option GDAL_TIFF_OVR_BLOCKSIZE
             # FIXME : to set the internal overview blocksize ; however it is set at 128 as default, as requested here
             # Source : https://gdal.org/drivers/raster/gtiff.html#raster-gtiff
             # add in options : "GDAL_TIFF_OVR_BLOCKSIZE=" + str(config.get('internal_overviews'))
 
             dst_ds.BuildOverviews(resampling_algo, downsampling_levels)
-            driver_Gtiff = gdal.GetDriverByName("GTiff")
             try:
-                data_set2 = driver_Gtiff.CreateCopy(
-                    self.filepath, dst_ds, options=creation_options + ["COPY_SRC_OVERVIEWS=YES"]
+                data_set2 = _GTIFF_DRIVER.CreateCopy(
+                    self.filepath, dst_ds, options=_to_gdal_options(creation_options) + ["COPY_SRC_OVERVIEWS=YES"]
                 )
                 data_set2 = None  # noqa: F841
             except RuntimeError as err:
@@ -17,45 +17,23 @@
 # limitations under the License.
 """Sentinel 2 L1 like product module"""
 from datetime import datetime
+from functools import cached_property, lru_cache
 
-from adapter import AngleGrid, MaskFileDef, MeanAngle, ProductAdapter
+from adapter import MSK_CLASSI, AngleGrid, MaskFileDef, MeanAngle, ProductAdapter
 from osgeo import osr
 
 YYYYMMDDTHHMMSS = "%Y%m%dT%H%M%S"
 
-# Possible Masks
-MASK_TABLE = [
-    MaskFileDef("MSK_DETFOO", "0", "MSK_DETFOO_B01.jp2"),
-    MaskFileDef("MSK_QUALIT", "0", "MSK_QUALIT_B01.jp2"),
-    MaskFileDef("MSK_DETFOO", "1", "MSK_DETFOO_B02.jp2"),
-    MaskFileDef("MSK_QUALIT", "1", "MSK_QUALIT_B02.jp2"),
-    MaskFileDef("MSK_DETFOO", "2", "MSK_DETFOO_B03.jp2"),
-    MaskFileDef("MSK_QUALIT", "2", "MSK_QUALIT_B03.jp2"),
-    MaskFileDef("MSK_DETFOO", "3", "MSK_DETFOO_B04.jp2"),
-    MaskFileDef("MSK_QUALIT", "3", "MSK_QUALIT_B04.jp2"),
-    MaskFileDef("MSK_DETFOO", "4", "MSK_DETFOO_B05.jp2"),
-    MaskFileDef("MSK_QUALIT", "4", "MSK_QUALIT_B05.jp2"),
-    MaskFileDef("MSK_DETFOO", "5", "MSK_DETFOO_B06.jp2"),
-    MaskFileDef("MSK_QUALIT", "5", "MSK_QUALIT_B06.jp2"),
-    MaskFileDef("MSK_DETFOO", "6", "MSK_DETFOO_B07.jp2"),
-    MaskFileDef("MSK_QUALIT", "6", "MSK_QUALIT_B07.jp2"),
-    MaskFileDef("MSK_DETFOO", "7", "MSK_DETFOO_B08.jp2"),
-    MaskFileDef("MSK_QUALIT", "7", "MSK_QUALIT_B08.jp2"),
-    MaskFileDef("MSK_DETFOO", "8", "MSK_DETFOO_B8A.jp2"),
-    MaskFileDef("MSK_QUALIT", "8", "MSK_QUALIT_B8A.jp2"),
-    MaskFileDef("MSK_DETFOO", "9", "MSK_DETFOO_B09.jp2"),
-    MaskFileDef("MSK_QUALIT", "9", "MSK_QUALIT_B09.jp2"),
-    MaskFileDef("MSK_DETFOO", "10", "MSK_DETFOO_B10.jp2"),
-    MaskFileDef("MSK_QUALIT", "10", "MSK_QUALIT_B10.jp2"),
-    MaskFileDef("MSK_DETFOO", "11", "MSK_DETFOO_B11.jp2"),
-    MaskFileDef("MSK_QUALIT", "11", "MSK_QUALIT_B11.jp2"),
-    MaskFileDef("MSK_DETFOO", "12", "MSK_DETFOO_B12.jp2"),
-    MaskFileDef("MSK_QUALIT", "12", "MSK_QUALIT_B12.jp2"),
-    MaskFileDef("MSK_CLASSI", None, "MSK_CLASSI_B00.tif"),
-]
-
-
-BAND_LIST = [
+
+@lru_cache(maxsize=32)
+def _epsg_name(epsg_code: int) -> str:
+    """Projection name of an EPSG code, shared by all products, the EPSG database is only queried once per code"""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg_code)
+    return srs.GetAttrValue("projcs")
+
+
+BAND_LIST = (
     "B01",
     "B02",
     "B03",
@@ -69,7 +47,18 @@ BAND_LIST = [
     "B10",
     "B11",
     "B12",
-]
+)
+
+# product image files, bands and true color image
+IMAGE_LIST = BAND_LIST + ("TCI",)
+
+# Possible Masks, iterated in this order to build the product, lookups are keyed by MaskFileDef (hashable).
+# Detector footprint and quality masks of each band, band id being the band index in BAND_LIST
+MASK_TABLE = tuple(
+    MaskFileDef(mask_type, str(band_id), f"{mask_type}_{band}.jp2")
+    for band_id, band in enumerate(BAND_LIST)
+    for mask_type in ("MSK_DETFOO", "MSK_QUALIT")
+) + (MSK_CLASSI,)
 
 
 class Sen2LikeProduct:
@@ -93,8 +82,8 @@ class Sen2LikeProduct:
     # L1C_T12SYH_A028524_20220822T180505
     _short_granule_identifier_tpl = "{}_T{}_A{}_{}"
 
-    # T12SYH_20220822T175909_B01
-    _image_filename_tpl = "T{}_{}_{}"
+    # T12SYH_20220822T175909_B01, without band
+    _image_filename_prefix_tpl = "T{}_{}_"
 
     _processing_baseline = "0000"
     _processing_baseline_dotted = "00.00"
@@ -105,7 +94,8 @@ class Sen2LikeProduct:
         # bands image files by band name
         self._band_files = {}
 
-    @property
+    # identifiers and file names only depend on adapter values and product date, they are formatted once
+    @cached_property
     def datatake_identifier(self):
         # GS2B_20220822T175909_028524_N04.00
         return self._datatake_identifier_tpl.format(
@@ -115,7 +105,7 @@ class Sen2LikeProduct:
             self._processing_baseline_dotted,
         )
 
-    @property
+    @cached_property
     def product_name(self) -> str:
         """Get SAFE product name.
         Example: S2P_MSIL1C_20220822T175909_N0400_R041_T12SYH_20220822T201139.SAFE
@@ -133,7 +123,7 @@ class Sen2LikeProduct:
             self._product_date.strftime(YYYYMMDDTHHMMSS),
         )
 
-    @property
+    @cached_property
     def datastrip_identifier(self) -> str:
         """Get datastrip identifier.
         Example: S2B_OPER_MSI_L1C_DS_2BPS_20220822T201139_S20220822T180505_N04.00
@@ -153,7 +143,7 @@ class Sen2LikeProduct:
             self._processing_baseline_dotted,
         )
 
-    @property
+    @cached_property
     def long_granule_identifier(self) -> str:
         # S2B_OPER_MSI_L1C_TL_2BPS_20220822T201139_A028524_T12SYH_N04.00
 
@@ -167,7 +157,7 @@ class Sen2LikeProduct:
             self._processing_baseline_dotted,
         )
 
-    @property
+    @cached_property
     def short_granule_identifier(self) -> str:
         # L1C_T12SYH_A028524_20220822T180505
 
@@ -182,26 +172,29 @@ class Sen2LikeProduct:
     def sun_earth_correction(self) -> float:
         return self._product_adapter.sun_earth_correction
 
-    @property
+    @cached_property
     def pvi_filename(self) -> str:
         return self.get_image_filename("PVI") + ".tif"
 
-    @property
+    @cached_property
     def tci_filename(self) -> str:
         return self.get_image_filename("TCI") + ".TIF"
 
-    def get_image_filename(self, band: str) -> str:
-        return self._image_filename_tpl.format(
+    @cached_property
+    def _image_filename_prefix(self) -> str:
+        return self._image_filename_prefix_tpl.format(
             self._product_adapter.tile_number,
             self._product_adapter.granule_sensing_start.strftime(YYYYMMDDTHHMMSS),
-            band,
         )
 
+    def get_image_filename(self, band: str) -> str:
+        return self._image_filename_prefix + band
+
     @property
     def image_filename_list(self):
         # sample : T12SYH_20220822T175909_B01
         # NOTE : to update only for existing bands using self._band_files
-        for band in ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12", "TCI"]:
+        for band in IMAGE_LIST:
             yield self.get_image_filename(band)
 
     def get_mask_file(self, mask_file_def: MaskFileDef) -> str | None:
@@ -215,9 +208,43 @@ class Sen2LikeProduct:
         """
         return self._product_adapter.get_mask_file(mask_file_def)
 
+    def get_mask_files(self, mask_file_defs: tuple[MaskFileDef, ...]) -> dict[MaskFileDef, str | None]:
+        """Get mask file paths of the given definitions in a single pass,
+        a mask file shared by several definitions is only looked up once.
+
+        Args:
+            mask_file_defs (tuple[MaskFileDef, ...]): mask definitions
+
+        Returns:
+            dict[MaskFileDef, str|None]: mask file path by definition. None if not exists
+        """
+        mask_files = {}
+        for mask_file_def in mask_file_defs:
+            if mask_file_def not in mask_files:
+                mask_files[mask_file_def] = self.get_mask_file(mask_file_def)
+        return mask_files
+
     def get_band_file(self, band_name: str) -> str:
         return self._product_adapter.get_band_file(band_name)
 
+    @cached_property
+    def band_file_map(self) -> dict[str, str]:
+        """Image files of the product bands (BAND_LIST), built once.
+        Band files are generated if not already, see 'prefetch_band_files'.
+
+        Returns:
+            dict[str, str]: product image filename (without extension) by band image file path
+        """
+        return {self.get_band_file(band): self.get_image_filename(band) for band in BAND_LIST}
+
+    def prefetch_band_files(self, bands: list[str]):
+        """Generate image files of the given bands at once, concurrently
+
+        Args:
+            bands (list[str]): names of the bands to generate
+        """
+        self._product_adapter.prefetch_bands(bands)
+
     @property
     def spacecraft(self) -> str:
         return self._product_adapter.spacecraft
@@ -322,9 +349,7 @@ class Sen2LikeProduct:
     def epsg_code(self) -> str:
         return self._product_adapter.tile_info.epsg
 
-    @property
+    @cached_property
     def epsg_name(self) -> str:
-        srs = osr.SpatialReference()
-        srs.ImportFromEPSG(int(self.epsg_code))
         # WGS84 / UTM zone 12N
-        return srs.GetAttrValue("projcs")
+        return _epsg_name(int(self.epsg_code))
@@ -18,11 +18,76 @@
 
 
 import datetime
+import hashlib
 
 import numpy as np
 from dateutil import tz
 from pyrsr import RelativeSpectralResponse
-from scipy import interpolate
+from pyrsr import __version__ as pyrsr_version
+from utils import read_dataset
+
+# Gaussian spectral response constants: exp(-(4 * ln2 * (x - wl) / fwhm) ** 2) * 2 * sqrt(ln2) / sqrt(pi) / fwhm
+_GAUSSIAN_EXP_FACTOR = 4 * np.log(2)
+_GAUSSIAN_NORM_FACTOR = 2 * np.sqrt(np.log(2)) / np.sqrt(np.pi)
+
+
+def _spectral_sampling(wl, interval, n_points):
+    # Spectral sampling of all bands and detectors: interval around central wavelength, with n_points
+    # wl: central wavelength with dims (n_detectors, n_bands)
+    # returns array with dims (n_detectors, n_bands, n_points)
+    return np.linspace(0, interval, n_points) + wl[:, :, np.newaxis] - interval / 2.0
+
+
+def _gaussian_spectral_responses(x_wl, wl, fwhm):
+    # Gaussian spectral responses of all bands and detectors at once, broadcast over the spectral sampling axis
+    # x_wl: spectral sampling with dims (n_detectors, n_bands, n_points)
+    # wl, fwhm: central wavelength and fwhm with dims (n_detectors, n_bands)
+    # returns array with dims (n_detectors, n_bands, n_points), bands with null fwhm having null response
+    wl = wl[:, :, np.newaxis]
+    fwhm = fwhm[:, :, np.newaxis]
+
+    # computed in place, see _GAUSSIAN_* factors
+    g_prisma = x_wl - wl
+    # https://stackoverflow.com/questions/29950557/ignore-divide-by-0-warning-in-numpy
+    with np.errstate(divide="ignore", invalid="ignore"):
+        g_prisma *= _GAUSSIAN_EXP_FACTOR
+        g_prisma /= fwhm
+        np.square(g_prisma, out=g_prisma)
+        np.negative(g_prisma, out=g_prisma)
+        np.exp(g_prisma, out=g_prisma)
+        g_prisma *= _GAUSSIAN_NORM_FACTOR / fwhm
+
+    g_prisma[:, fwhm.mean(axis=0)[:, 0] == 0.0, :] = 0.0
+
+    return g_prisma
+
+
+def _unnormalized_spectral_weights(x_wl, g_prisma, prisma_bands, rsr_wl, rsrs, s2_bands, n_bands_s2):
+    # Unnormalized spectral weights of the given PRISMA bands for the given S2 bands, others are null
+    # x_wl, g_prisma: spectral sampling and Gaussian responses with dims (n_detectors, n_bands, n_points)
+    # prisma_bands: boolean mask of the PRISMA bands to weight, rsrs: S2 responses sampled on rsr_wl
+    # returns array with dims (n_detectors, n_bands, n_bands_s2)
+    w_prisma = np.zeros((x_wl.shape[0], x_wl.shape[1], n_bands_s2), np.double)
+
+    for z in np.flatnonzero(prisma_bands):
+        # PRISMA band by band, so that its sampling and response stay in cache for all S2 bands
+        x_wl_z = np.ascontiguousarray(x_wl[:, z, :])
+        g_prisma_z = np.ascontiguousarray(g_prisma[:, z, :])
+        for b in s2_bands:
+            # linear interpolation of S2 response, weighted PRISMA bands are within rsr_wl range
+            w_prisma[:, z, b] = (g_prisma_z * np.interp(x_wl_z, rsr_wl, rsrs[b])).sum(axis=1)
+
+    return w_prisma
+
+
+def aggregation_coefficients_key(product_file):
+    # Digest of what aggregation coefficients depend on: PRISMA central wavelength and fwhm lists
+    # (HCO GLOBAL attributes) and the S2A spectral responses, that are the ones of the pyrsr version
+    digest = hashlib.blake2b(pyrsr_version.encode(), digest_size=16)
+    for name in ("List_Cw_Vnir", "List_Fwhm_Vnir", "List_Cw_Swir", "List_Fwhm_Swir"):
+        digest.update(np.ascontiguousarray(product_file.attrs.get(name), dtype=np.float32).tobytes())
+
+    return digest.hexdigest()
 
 
 def generate_aggregation_coefficients_prisma_s2(product_file):
@@ -56,14 +121,12 @@ def generate_aggregation_coefficients_prisma_s2(product_file):
     prisma_swir_wl_list = np.float32(product_file.attrs.get("List_Cw_Swir"))
     prisma_swir_fwhm_list = np.float32(product_file.attrs.get("List_Fwhm_Swir"))
 
-    # Replicate prisma_vnir_wl values per column with single List_cw_vnir value
-    prisma_vnir_wl = np.tile(prisma_vnir_wl_list, (n_detectors, 1))
-    prisma_vnir_fwhm = np.tile(prisma_vnir_fwhm_list, (n_detectors, 1))
-    prisma_swir_wl = np.tile(prisma_swir_wl_list, (n_detectors, 1))
-    prisma_swir_fwhm = np.tile(prisma_swir_fwhm_list, (n_detectors, 1))
-
-    n_bands_prisma_vnir = prisma_vnir_wl.shape[1]
-    n_bands_prisma_swir = prisma_swir_wl.shape[1]
+    # Same central wavelength and fwhm for all detectors: compute the coefficients once,
+    # for a single detector row, and replicate them per detector at the end
+    prisma_vnir_wl = prisma_vnir_wl_list[np.newaxis, :]
+    prisma_vnir_fwhm = prisma_vnir_fwhm_list[np.newaxis, :]
+    prisma_swir_wl = prisma_swir_wl_list[np.newaxis, :]
+    prisma_swir_fwhm = prisma_swir_fwhm_list[np.newaxis, :]
 
     # Compute and store the PRISMA Gaussian spectral responses for each band and detector
     # Interval of definition is +/- 10 nm around central wavelength,
@@ -76,111 +139,41 @@ def generate_aggregation_coefficients_prisma_s2(product_file):
     # Number of points used for Gaussian Spectral responses definitions
     n_points = 10 * interval + 1
 
-    # Initialize and then generate PRISMA Gaussian Spectral responses (VNIR)
-    g_prisma_vnir = np.zeros((n_detectors, n_bands_prisma_vnir, n_points), np.double)
-
-    for z in range(n_bands_prisma_vnir):
-        prisma_vnir_wl_arr = np.array(np.tile(np.matrix(prisma_vnir_wl[:, z]).transpose(), (1, n_points)))
-        prisma_vnir_fwhm_arr = np.array(np.tile(np.matrix(prisma_vnir_fwhm[:, z]).transpose(), (1, n_points)))
-        x_arr = np.array(np.tile(np.linspace(0, interval, n_points), (n_detectors, 1)))
-        x_wl = x_arr + prisma_vnir_wl_arr - interval / 2.0
-
-        if prisma_vnir_fwhm_arr.mean() == 0.0:
-            continue
-        else:
-            # https://stackoverflow.com/questions/29950557/ignore-divide-by-0-warning-in-numpy
-            with np.errstate(divide="ignore", invalid="ignore"):
-                g_prisma_vnir[:, z, :] = (
-                    2
-                    * np.sqrt(np.log(2))
-                    / np.sqrt(np.pi)
-                    / prisma_vnir_fwhm_arr
-                    * np.exp(-np.power((4 * np.log(2) * (x_wl - prisma_vnir_wl_arr) / prisma_vnir_fwhm_arr), 2))
-                )
-
-    # Initialize and then generate PRISMA Gaussian Spectral responses (SWIR)
-    g_prisma_swir = np.zeros((n_detectors, n_bands_prisma_swir, n_points), np.double)
-
-    for z in range(n_bands_prisma_swir):
-        prisma_swir_wl_arr = np.array(np.tile(np.matrix(prisma_swir_wl[:, z]).transpose(), (1, n_points)))
-        prisma_swir_fwhm_arr = np.array(np.tile(np.matrix(prisma_swir_fwhm[:, z]).transpose(), (1, n_points)))
-        x_arr = np.array(np.tile(np.linspace(0, interval, n_points), (n_detectors, 1)))
-        x_wl = x_arr + prisma_swir_wl_arr - interval / 2.0
-
-        if prisma_swir_fwhm_arr.mean() == 0.0:
-            continue
-        else:
-            # https://stackoverflow.com/questions/29950557/ignore-divide-by-0-warning-in-numpy
-            with np.errstate(divide="ignore", invalid="ignore"):
-                g_prisma_swir[:, z, :] = (
-                    2
-                    * np.sqrt(np.log(2))
-                    / np.sqrt(np.pi)
-                    / prisma_swir_fwhm_arr
-                    * np.exp(-np.power((4 * np.log(2) * (x_wl - prisma_swir_wl_arr) / prisma_swir_fwhm_arr), 2))
-                )
-
-    # Initialize and then compute Unnormalized Spectral Weight for each PRISMA band (VNIR)
-    w_prisma_vnir = np.zeros((n_detectors, n_bands_prisma_vnir, n_bands_s2), np.double)
-
-    for z in range(n_bands_prisma_vnir):
-        prisma_vnir_wl_arr = np.array(np.tile(np.matrix(prisma_vnir_wl[:, z]).transpose(), (1, n_points)))
-        g_prisma_vnir_arr = g_prisma_vnir[:, z, :]
-        x_arr = np.array(np.tile(np.linspace(0, interval, n_points), (n_detectors, 1)))
-        x_wl = x_arr + prisma_vnir_wl_arr - interval / 2.0
-
-        # exclude PRISMA bands with wls out of S2 spectral range
-        if x_wl.min() < rsr_s2a_wl.min():
-            continue
-
-        for b, (band, rsr) in enumerate(rsr_s2a.rsrs.items()):
-            # b > 9 exclude S2 SWIR bands with break
-            if b > 9:
-                break
-            f = interpolate.interp1d(rsr_s2a_wl, rsr)
-            f_s2_bk = f(x_wl)
-            w_prisma_vnir[:, z, b] = (g_prisma_vnir_arr * f_s2_bk).sum(axis=1)
-
-    # Initialize and then compute Unnormalized Spectral Weight for each PRISMA band (SWIR)
-    w_prisma_swir = np.zeros((n_detectors, n_bands_prisma_swir, n_bands_s2), np.double)
-
-    for z in range(n_bands_prisma_swir):
-        prisma_swir_wl_arr = np.array(np.tile(np.matrix(prisma_swir_wl[:, z]).transpose(), (1, n_points)))
-        g_prisma_swir_arr = g_prisma_swir[:, z, :]
-        x_arr = np.array(np.tile(np.linspace(0, interval, 10 * interval + 1), (n_detectors, 1)))
-        x_wl = x_arr + prisma_swir_wl_arr - interval / 2.0
-
-        # exclude PRISMA bands with wls out of S2 spectral range
-        if x_wl.max() > rsr_s2a_wl.max() or x_wl.min() < rsr_s2a_wl.min():
-            continue
-
-        for b, (band, rsr) in enumerate(rsr_s2a.rsrs.items()):
-            # b < 10 exclude S2 VNIR bands with continue
-            if b < 10:
-                continue
-            f = interpolate.interp1d(rsr_s2a_wl, rsr)
-            f_s2_bk = f(x_wl)
-            w_prisma_swir[:, z, b] = (g_prisma_swir_arr * f_s2_bk).sum(axis=1)
-
-    # Initialize Normalized Spectral Weight for each PRISMA band (VNIR)
-    p_prisma_vnir = np.zeros((n_detectors, n_bands_prisma_vnir, n_bands_s2), np.double)
-
-    for b in range(n_bands_s2):
-        # b > 9 exclude S2 SWIR bands
-        if b > 9:
-            break
-        for x in range(n_detectors):
-            p_prisma_vnir[x, :, b] = w_prisma_vnir[x, :, b] / np.nansum(w_prisma_vnir[x, :, b])
-
-    # Initialize Normalized Spectral Weight for each PRISMA band (SWIR)
-    p_prisma_swir = np.zeros((n_detectors, n_bands_prisma_swir, n_bands_s2), np.double)
-
-    for b in range(n_bands_s2):
-        # b < 10 exclude S2 VNIR bands
-        if b < 10:
-            continue
-        for x in range(n_detectors):
-            p_prisma_swir[x, :, b] = w_prisma_swir[x, :, b] / np.nansum(w_prisma_swir[x, :, b])
+    # Generate PRISMA Gaussian Spectral responses (VNIR & SWIR)
+    x_wl_vnir = _spectral_sampling(prisma_vnir_wl, interval, n_points)
+    x_wl_swir = _spectral_sampling(prisma_swir_wl, interval, n_points)
+    g_prisma_vnir = _gaussian_spectral_responses(x_wl_vnir, prisma_vnir_wl, prisma_vnir_fwhm)
+    g_prisma_swir = _gaussian_spectral_responses(x_wl_swir, prisma_swir_wl, prisma_swir_fwhm)
+
+    rsr_s2a_bands = list(rsr_s2a.rsrs.values())
+
+    # Compute Unnormalized Spectral Weight for each PRISMA band (VNIR), for S2 VNIR bands (b <= 9)
+    # exclude PRISMA bands with wls out of S2 spectral range
+    vnir_bands = x_wl_vnir.min(axis=(0, 2)) >= rsr_s2a_wl.min()
+    w_prisma_vnir = _unnormalized_spectral_weights(
+        x_wl_vnir, g_prisma_vnir, vnir_bands, rsr_s2a_wl, rsr_s2a_bands, range(10), n_bands_s2
+    )
+
+    # Compute Unnormalized Spectral Weight for each PRISMA band (SWIR), for S2 SWIR bands (b >= 10)
+    # exclude PRISMA bands with wls out of S2 spectral range
+    swir_bands = (x_wl_swir.max(axis=(0, 2)) <= rsr_s2a_wl.max()) & (x_wl_swir.min(axis=(0, 2)) >= rsr_s2a_wl.min())
+    w_prisma_swir = _unnormalized_spectral_weights(
+        x_wl_swir, g_prisma_swir, swir_bands, rsr_s2a_wl, rsr_s2a_bands, range(10, n_bands_s2), n_bands_s2
+    )
+
+    # Normalized Spectral Weight for each PRISMA band (VNIR), normalized per detector and S2 band.
+    # A detector without any contributing PRISMA band gives NaN, as before
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p_prisma_vnir = w_prisma_vnir / np.nansum(w_prisma_vnir, axis=1, keepdims=True)
+        p_prisma_swir = w_prisma_swir / np.nansum(w_prisma_swir, axis=1, keepdims=True)
+
+    # exclude S2 SWIR bands from VNIR and S2 VNIR bands from SWIR
+    p_prisma_vnir[..., 10:] = 0.0
+    p_prisma_swir[..., :10] = 0.0
+
+    # Replicate coefficients per detector, in float32 as the radiance cubes they aggregate
+    p_prisma_vnir = np.repeat(p_prisma_vnir.astype(np.float32), n_detectors // p_prisma_vnir.shape[0], axis=0)
+    p_prisma_swir = np.repeat(p_prisma_swir.astype(np.float32), n_detectors // p_prisma_swir.shape[0], axis=0)
 
     return p_prisma_vnir, p_prisma_swir
 
@@ -197,12 +190,14 @@ def read_cube_to_radiance(product_file, cube):
         offset = np.float32(product_file.attrs.get("Offset_Swir"))
         image_cube = product_file["HDFEOS/SWATHS/PRS_L1_HCO/Data Fields/SWIR_Cube"]
 
-    # returns array with dims (1000, 1000, n_bands_prisma)
-    image_cube_radiance = np.array(image_cube).swapaxes(1, 2)
-    # rotate the 66 images by 90 deg clockwise
-    image_cube_radiance = np.rot90(image_cube_radiance, k=-1)
-    # convert to radiance
-    image_cube_radiance = (image_cube_radiance / gain + offset).astype(np.float32)
+    # dataset has dims (1000, n_bands_prisma, 1000), get a band-major view with dims (n_bands_prisma, 1000, 1000)
+    # of the images rotated by 90 deg clockwise, as a single transpose and flip
+    image_cube_counts = read_dataset(image_cube).transpose(1, 2, 0)[:, :, ::-1]
+    # convert to radiance, directly in a float32 cube having contiguous band planes,
+    # multiplying by the reciprocal gain that is cheaper than a divide
+    image_cube_radiance = np.empty(image_cube_counts.shape, dtype=np.float32)
+    np.multiply(image_cube_counts, np.float32(1.0 / gain), out=image_cube_radiance)
+    image_cube_radiance += offset
 
     return image_cube_radiance
 
@@ -219,37 +214,44 @@ def read_cube_to_radiance_l1g(product_file, cube):
         offset = np.float32(product_file.attrs.get("Offset_Swir"))
         image_cube = product_file["HDFEOS/SWATHS/PRS_L1_HCO/Data Fields/SWIR_Cube"]
 
-    # returns array with dims (nl, ns, n_bands_prisma)
-    image_cube_radiance = np.array(image_cube).swapaxes(1, 2)
-    # rotate the 66 images by 90 deg clockwise
-    # image_cube_radiance = np.rot90(image_cube_radiance, k=-1)
-    # convert to radiance
-    image_cube_radiance = (image_cube_radiance / gain + offset).astype(np.float32)
+    # dataset has dims (nl, n_bands_prisma, ns), get a band-major view with dims (n_bands_prisma, nl, ns)
+    # images are not rotated
+    image_cube_counts = read_dataset(image_cube).transpose(1, 0, 2)
+    # convert to radiance, directly in a float32 cube having contiguous band planes,
+    # multiplying by the reciprocal gain that is cheaper than a divide
+    image_cube_radiance = np.empty(image_cube_counts.shape, dtype=np.float32)
+    np.multiply(image_cube_counts, np.float32(1.0 / gain), out=image_cube_radiance)
+    image_cube_radiance += offset
 
     return image_cube_radiance
 
 
-def spectral_aggregation_prisma_s2(image_cube_radiance, p_prisma, b):
-    nl = image_cube_radiance.shape[0]
-    ns = image_cube_radiance.shape[1]
-    n_detectors = ns
-
-    # Initialize temporary prisma_aggreg_tmp to store PRISMA contribution for each S2 band
-    prisma_aggreg_tmp = np.zeros((nl, ns), np.double)
+def spectral_aggregation_prisma_s2(image_cube_radiance, p_prisma, out=None):
+    # Aggregate band-major PRISMA cube into all S2 bands of p_prisma in a single pass over the cube:
+    # out[b, l, x] = sum_z image_cube_radiance[z, l, x] * p_prisma[x, z, b]
+    # returns array with dims (n_bands_s2, nl, ns), written in out (C contiguous) if given
+    n_bands_prisma, nl, ns = image_cube_radiance.shape
+    p_prisma = p_prisma.astype(image_cube_radiance.dtype, copy=False)
 
-    for x in range(n_detectors):
-        prisma_indexes = p_prisma[x, :, b].nonzero()
+    if out is None:
+        out = np.empty((p_prisma.shape[2], nl, ns), dtype=image_cube_radiance.dtype)
 
-        for prisma_index in prisma_indexes[0]:
-            prisma_band = image_cube_radiance[:, x, prisma_index]
-            prisma_aggreg_tmp[:, x] = prisma_band * p_prisma[x, prisma_index, b] + prisma_aggreg_tmp[:, x]
+    if (p_prisma == p_prisma[0]).all():
+        # Same coefficients for all detectors (case of coregistered products HCO):
+        # a single matrix product over all the contiguous band planes
+        np.matmul(p_prisma[0].T, image_cube_radiance.reshape(n_bands_prisma, nl * ns), out=out.reshape(-1, nl * ns))
+    else:
+        # Coefficients depend on the detector (column x)
+        np.einsum("zlx,xzb->blx", image_cube_radiance, p_prisma, out=out)
 
-    return prisma_aggreg_tmp
+    return out
 
 
-def radiance_to_reflectance(radiance, esun, sza, sun_earth_distance):
+def radiance_to_reflectance(radiance, factor, out=None):
     # Conversion from radiance (W.m-2.sr-1.um-1) to reflectance (unitless)
-    reflectance = (1 / (esun * np.cos(np.radians(sza)))) * np.pi * radiance * sun_earth_distance**2
+    # factor is the precomputed pi * d**2 / (esun * cos(sza)), a band scalar or per band factors broadcast on a cube
+    # reflectance is written in out if given
+    reflectance = np.multiply(radiance, np.float32(factor), out=out)
 
     return reflectance
 
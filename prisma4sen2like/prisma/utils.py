@@ -19,7 +19,19 @@
 
 from datetime import datetime
 
+import h5py
+import numpy as np
+from numpy.typing import NDArray
+
 
 def utc_format(date_time: datetime):
     "Format datetime to YYYY-MM-DD'T'ss:mm:ss.SSS'Z'"
-    return f"{date_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]}Z"
+    # isoformat does not go through the locale aware strftime, tz is dropped as strftime does without %z
+    return f"{date_time.replace(tzinfo=None).isoformat(timespec='milliseconds')}Z"
+
+
+def read_dataset(dataset: h5py.Dataset) -> NDArray:
+    "Read a whole HDF5 dataset straight into a new array, each chunk going once through the filter pipeline"
+    out = np.empty(dataset.shape, dtype=dataset.dtype)
+    dataset.read_direct(out)
+    return out
@@ -0,0 +1,86 @@
+"""interpolate_gps_position tests, run from prisma4sen2like folder with `PYTHONPATH=prisma pytest tests`"""
+from unittest import TestCase
+
+import numpy as np
+from adapter import interpolate_gps_position
+
+# PRISMA line time is ~4.3 ms, GPS values are updated at 1 Hz
+HOLD_STEP = 230
+NB_SAMPLES = 1000
+
+
+def _polyfit_gps_position(v):
+    """former implementation, global linear fit, 1-based samples and knots ordered by value"""
+    u = np.unique(v)
+    indice = []
+    for rec in u[1:]:
+        i = np.where(v == rec)[0][0]
+        indice.append(i)
+    x_0 = np.linspace(1, v.shape[0], v.shape[0])
+    x = np.array(indice)
+    y = u[1:]
+    [p, o] = np.polyfit(x, y, deg=1)
+
+    return p * x_0 + o
+
+
+def _hold(position, offset=57):
+    """Hold values of `position(sample)` updated every HOLD_STEP samples, first update at `offset`"""
+    samples = np.arange(NB_SAMPLES)
+    # time of last update of each sample, first samples hold the update before acquisition start
+    update = offset + np.floor((samples - offset) / HOLD_STEP) * HOLD_STEP
+    return position(update)
+
+
+class TestInterpolateGpsPosition(TestCase):
+    """interpolate_gps_position test class"""
+
+    def test_linear_increasing(self):
+        """same line as the former polyfit, shifted by one sample as samples are now 0-based"""
+        v = _hold(lambda t: 6.9e6 + 7.5 * t)
+
+        positions = interpolate_gps_position(v)
+
+        np.testing.assert_allclose(positions, 6.9e6 + 7.5 * np.arange(NB_SAMPLES), rtol=0, atol=1e-6)
+        np.testing.assert_allclose(positions[1:], _polyfit_gps_position(v)[:-1], rtol=0, atol=1e-6)
+
+    def test_linear_decreasing(self):
+        """first sample value is not a knot even if it is not the smallest value"""
+        v = _hold(lambda t: -6.9e6 - 7.5 * t)
+
+        positions = interpolate_gps_position(v)
+
+        np.testing.assert_allclose(positions, -6.9e6 - 7.5 * np.arange(NB_SAMPLES), rtol=0, atol=1e-6)
+        np.testing.assert_allclose(positions, -interpolate_gps_position(-v), rtol=0, atol=1e-6)
+        # former implementation used the first sample value as a knot and dropped the last update
+        self.assertGreater(np.abs(positions[1:] - _polyfit_gps_position(v)[:-1]).max(), 1.0)
+
+    def test_curved_orbit(self):
+        """piecewise interpolation follows the orbit closer than the global fit"""
+
+        def position(t):
+            return 6.9e6 * np.sin(1e-3 * t + 0.3)
+
+        v = _hold(position)
+        truth = position(np.arange(NB_SAMPLES))
+
+        error = np.abs(interpolate_gps_position(v) - truth)[60:-60]
+        polyfit_error = np.abs(_polyfit_gps_position(v) - truth)[60:-60]
+
+        self.assertLess(error.max(), polyfit_error.max() / 5)
+
+    def test_no_update(self):
+        """held value is returned when GPS value is never updated"""
+        v = np.full(NB_SAMPLES, 6.9e6, dtype=np.float32)
+
+        positions = interpolate_gps_position(v)
+
+        self.assertEqual(positions.dtype, np.float64)
+        np.testing.assert_array_equal(positions, np.full(NB_SAMPLES, 6.9e6))
+
+    def test_single_update(self):
+        """knot value is returned when there is a single update, no segment to extrapolate with"""
+        v = np.full(NB_SAMPLES, 6.9e6)
+        v[400:] = 7.0e6
+
+        np.testing.assert_array_equal(interpolate_gps_position(v), np.full(NB_SAMPLES, 7.0e6))
@@ -25,6 +25,7 @@ import re
 import tarfile
 import urllib.request
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory
 from urllib.error import HTTPError
 
@@ -33,6 +34,22 @@ from osgeo import gdal, ogr
 
 LOGGER = logging.getLogger("Sen2Like")
 
+# Max number of DEM tiles downloaded concurrently
+DOWNLOAD_WORKERS = 8
+# Download read block size and socket timeout (seconds)
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+# Default working memory of DEM warp, in MB
+WARP_MEMORY_LIMIT = 1024
+# Generated DEM no-data value, only used outside of source DEM tiles extent
+DEM_NODATA = -20000
+# Generated DEM creation options
+DEM_CREATION_OPTIONS = ["TILED=YES", "COMPRESS=DEFLATE", "PREDICTOR=2", "BIGTIFF=IF_SAFER"]
+
+# DEM dataset name expression to extract resolution, type of DEM, year and rev
+DATASET_EXPR = re.compile(r"COP-DEM_GLO-(\d{2})-(DGED|DTED)__(\d{4})_(\d{1})")
+
 # Apply proposed patch https://github.com/senbox-org/sen2like/pull/2
 # for CVE-2007-4559 Patch
 
@@ -41,18 +58,25 @@ def is_within_directory(directory, target):
     abs_directory = os.path.abspath(directory)
     abs_target = os.path.abspath(target)
 
-    prefix = os.path.commonprefix([abs_directory, abs_target])
-
-    return prefix == abs_directory
+    # compare path components, a string prefix would accept a sibling like "/dir2" for "/dir"
+    return os.path.commonpath([abs_directory, abs_target]) == abs_directory
 
 
 def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-    for member in tar.getmembers():
+    # check and extract each member in a single forward pass over the archive
+    for member in tar if members is None else members:
         member_path = os.path.join(path, member.name)
         if not is_within_directory(path, member_path):
             raise Exception("Attempted Path Traversal in Tar File")
 
-    tar.extractall(path, members, numeric_owner=numeric_owner)
+        # links must not point outside the directory either,
+        # symbolic link target is relative to the link folder, hard link one to the archive root
+        if member.issym() or member.islnk():
+            link_dir = os.path.dirname(member_path) if member.issym() else path
+            if not is_within_directory(path, os.path.join(link_dir, member.linkname)):
+                raise Exception("Attempted Link Outside Of Extraction Folder in Tar File")
+
+        tar.extract(member, path, numeric_owner=numeric_owner)
 
 
 # EO Patch
@@ -86,24 +110,22 @@ def is_local(url: str) -> bool:
     return True
 
 
-def progress(downloaded, block_size, data_size):
-    """Display download progression.
+def download(url: str, file_path: str) -> int:
+    """Download url content in a local file, streamed by large blocks.
 
     Args:
-        downloaded: Amount of data already downloaded.
-        block_size: Size of a data block.
-        data_size: Total size of data to download.
-    """
-    percentage = downloaded * block_size / data_size
-    end = ""
-    if percentage > 100:
-        percentage = 100.0
-        end = "\n"
-    print(f"\r{percentage:.2%}...", end=end)
+        url (str): url of the content to download
+        file_path (str): destination file path
 
+    Returns:
+        int: downloaded size in bytes
+    """
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response, open(file_path, "wb") as file:
+        downloaded = 0
+        while block := response.read(DOWNLOAD_BLOCK_SIZE):
+            downloaded += file.write(block)
 
-# DEM dataset name expression to extract resolution, type of DEM, year and rev
-DATASET_EXPR = re.compile(r"COP-DEM_GLO-(\d{2})-(DGED|DTED)__(\d{4})_(\d{1})")
+    return downloaded
 
 
 class HelpFormatter(RawTextHelpFormatter, ArgumentDefaultsHelpFormatter):
@@ -121,12 +143,15 @@ class DemDownloader:
     Mosaic the tiles, resample (if requested), and crop the tile to fit the input extent.
     """
 
-    def __init__(self, args, in_resolution: int = 90, resolution: int = 90):
+    def __init__(
+        self, args, in_resolution: int = 90, resolution: int = 90, warp_memory_limit: int = WARP_MEMORY_LIMIT
+    ):
         self.config = args
         self.mgrs_tile_code: str = args.mgrs_tile_code
         self._mgrs_def: dict = {}
         self.resolution: int = resolution
         self.in_resolution: int = in_resolution
+        self.warp_memory_limit: int = warp_memory_limit
         self.temp_directory: TemporaryDirectory = None
         self._dem_output: str = ""
         self.cross_dateline: bool = False
@@ -301,17 +326,24 @@ class DemDownloader:
         """
         LOGGER.info("Trying to retrieve or download DEM for tile %s", self.mgrs_tile_code)
 
-        exclude = []
-        for location, tile_file in tile_urls.items():
+        missing_tiles = {
+            location: tile_file for location, tile_file in tile_urls.items() if not os.path.isfile(tile_file)
+        }
+
+        # Create destination dirs first, downloaded tiles are extracted concurrently in the same ones
+        for output_dir in {os.path.dirname(tile_file) for tile_file in missing_tiles.values()}:
+            os.makedirs(output_dir, exist_ok=True)
+
+        # Download missing tiles concurrently, each one is network bound.
+        # list() consumes results so that errors are raised as with sequential downloads
+        with ThreadPoolExecutor(DOWNLOAD_WORKERS) as executor:
+            list(executor.map(self.download_tile, missing_tiles, map(os.path.dirname, missing_tiles.values())))
+
+        for location, tile_file in missing_tiles.items():
+            # After download file must exist
             if not os.path.isfile(tile_file):
-                output_dir = os.path.dirname(tile_file)
-                self.download_tile(location, output_dir)
-                # After download file must exist
-                if not os.path.isfile(tile_file):
-                    LOGGER.warning("Unable to download tile for %s, exclude it.", location)
-                    exclude.append(location)
-        for location in exclude:
-            tile_urls.pop(location)
+                LOGGER.warning("Unable to download tile for %s, exclude it.", location)
+                tile_urls.pop(location)
 
     def download_tile(self, location: tuple, output_dir: str):
         """
@@ -327,48 +359,40 @@ class DemDownloader:
             tmp_file = os.path.join(self.temp_directory.name, os.path.basename(dem_url))
             try:
                 LOGGER.info("Downloading file to %s", tmp_file)
-                local_dem, _ = urllib.request.urlretrieve(dem_url, tmp_file, reporthook=progress)
-                LOGGER.info("File correctly downloaded")
+                # tiles are downloaded concurrently, so report each finished one instead of a progression
+                downloaded = download(dem_url, tmp_file)
+                LOGGER.info("File %s correctly downloaded (%d bytes)", tmp_file, downloaded)
             except HTTPError as err:
                 LOGGER.error("Cannot get file %s : %s", dem_url, err)
             else:
-                LOGGER.info("Extract file %s", local_dem)
-                with tarfile.open(local_dem) as tar_file:
+                LOGGER.info("Extract file %s", tmp_file)
+                with tarfile.open(tmp_file) as tar_file:
                     safe_extract(tar_file, path=output_dir, members=dem_file_from_tar(tar_file))
 
     def _create_dem_mosaic(self, dem_mosaic_file: str, dem_files: list[str]):
-        """Create DEM mosaic from source DEM tile
+        """Create DEM virtual mosaic from source DEM tiles.
+        Mosaic has no no-data, areas without source DEM or with source no-data read as 0,
+        so that it can be directly reframed.
 
         Args:
-            dem_mosaic_file (str): mosaic destination file path
+            dem_mosaic_file (str): mosaic destination VRT file path
             dem_files (list[str]): list of sources dem tile file path
         """
         LOGGER.info("Creating DEM mosaic...")
-        no_data = -20000
         try:
             # Mosaic
             if self.cross_dateline:
                 gdal.SetConfigOption("CENTER_LONG", "180")
 
-            options = gdal.WarpOptions(
-                dstNodata=no_data, outputType=gdal.GDT_Int16, dstSRS="EPSG:4326"
-            )
-
-            dataset = gdal.Warp(dem_mosaic_file, dem_files, options=options)
+            options = gdal.BuildVRTOptions(VRTNodata="None")
 
-            # Replace no-data by 0
-            dem_band = dataset.GetRasterBand(1)
-            dem_arr = dem_band.ReadAsArray()
-            dem_arr[dem_arr == no_data] = 0
-            dem_band.WriteArray(dem_arr)
-            dem_band.FlushCache()
-            dataset = None
+            gdal.BuildVRT(dem_mosaic_file, dem_files, options=options)
 
             gdal.SetConfigOption("CENTER_LONG", "0")
             LOGGER.debug("DEM mosaic: %s", dem_mosaic_file)
         except Exception as exception:
             LOGGER.fatal(exception, exc_info=True)
-            LOGGER.fatal("error using gdalwarp")
+            LOGGER.fatal("error using gdalbuildvrt")
             raise
 
     def _reframe_dem(self, dem_mosaic_file: str):
@@ -388,6 +412,12 @@ class DemDownloader:
             resampleAlg="cubicspline",
             outputType=gdal.GDT_Int16,
             outputBounds=(extent[0], extent[2], extent[1], extent[3]),
+            # as when warped from the former GeoTIFF mosaic whose no-data was propagated
+            dstNodata=DEM_NODATA,
+            creationOptions=DEM_CREATION_OPTIONS,
+            multithread=True,
+            warpOptions=["NUM_THREADS=ALL_CPUS"],
+            warpMemoryLimit=self.warp_memory_limit,
         )
 
         try:
@@ -406,7 +436,7 @@ class DemDownloader:
 
         dem_mosaic = os.path.join(
             self.temp_directory.name,
-            f"Copernicus_{self.mgrs_tile_code}_{self.resolution}_mosaic.tif",
+            f"Copernicus_{self.mgrs_tile_code}_{self.resolution}_mosaic.vrt",
         )
 
         self._create_dem_mosaic(dem_mosaic, dem_files)
@@ -456,6 +486,16 @@ Generated files are stored as follow :
         metavar="SERVER_URL",
     )
 
+    _arg_parser.add_argument(
+        "--warp_memory_limit",
+        dest="warp_memory_limit",
+        help="Working memory of the DEM warp in MB",
+        required=False,
+        type=int,
+        default=WARP_MEMORY_LIMIT,
+        metavar="WARP_MEMORY_LIMIT",
+    )
+
     _arg_parser.add_argument(
         "--debug",
         "-d",
@@ -482,5 +522,7 @@ Generated files are stored as follow :
         )
 
     res = int(match.group(1))
-    dem_downloader = DemDownloader(_args, in_resolution=res, resolution=res)
+    dem_downloader = DemDownloader(
+        _args, in_resolution=res, resolution=res, warp_memory_limit=_args.warp_memory_limit
+    )
     dem = dem_downloader.get()
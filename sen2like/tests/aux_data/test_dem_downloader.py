@@ -1,9 +1,14 @@
+import io
 import os
 import shutil
+import tarfile
 from dataclasses import dataclass
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
-from dem.dem_downloader import DemDownloader
+import numpy as np
+from dem.dem_downloader import DEM_NODATA, DemDownloader, dem_file_from_tar, safe_extract
+from osgeo import gdal, osr
 
 LOCAL_TMP = "/tmp/DEM"
 
@@ -74,3 +79,197 @@ class TestDemDownloader(TestCase):
         arg.mgrs_tile_code = "12SY"
         dem_downloader = DemDownloader(arg)
         self.assertRaises(ValueError, dem_downloader.get)
+
+
+def _add_file(tar_file: tarfile.TarFile, name: str):
+    """add a regular file member having its name as content"""
+    content = name.encode()
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(content)
+    tar_file.addfile(tarinfo, io.BytesIO(content))
+
+
+def _add_symlink(tar_file: tarfile.TarFile, name: str, link_name: str):
+    """add a symbolic link member"""
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.type = tarfile.SYMTYPE
+    tarinfo.linkname = link_name
+    tar_file.addfile(tarinfo)
+
+
+class TestSafeExtract(TestCase):
+    """safe_extract and dem_file_from_tar test class"""
+
+    def setUp(self):
+        self._temp_dir = TemporaryDirectory()
+        self.tar_path = os.path.join(self._temp_dir.name, "tile.tar")
+        self.output_dir = os.path.join(self._temp_dir.name, "geocells")
+        os.makedirs(self.output_dir)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def _extract(self, members: bool = False):
+        with tarfile.open(self.tar_path) as tar_file:
+            safe_extract(tar_file, path=self.output_dir, members=dem_file_from_tar(tar_file) if members else None)
+
+    def test_extract_dem_file(self):
+        with tarfile.open(self.tar_path, "w") as tar_file:
+            _add_file(tar_file, "Copernicus_DSM_30_N41_00_E011_00/INFO/Copernicus_DSM_30_N41_00_E011_00.xml")
+            _add_file(tar_file, "Copernicus_DSM_30_N41_00_E011_00/DEM/Copernicus_DSM_30_N41_00_E011_00_DEM.tif")
+
+        self._extract(members=True)
+
+        # only the DEM file, flattened to its basename
+        self.assertEqual(os.listdir(self.output_dir), ["Copernicus_DSM_30_N41_00_E011_00_DEM.tif"])
+        with open(os.path.join(self.output_dir, "Copernicus_DSM_30_N41_00_E011_00_DEM.tif"), "rb") as dem_file:
+            self.assertEqual(
+                dem_file.read(), b"Copernicus_DSM_30_N41_00_E011_00/DEM/Copernicus_DSM_30_N41_00_E011_00_DEM.tif"
+            )
+
+    def test_reject_parent_path(self):
+        with tarfile.open(self.tar_path, "w") as tar_file:
+            _add_file(tar_file, "../x")
+
+        self.assertRaises(Exception, self._extract)
+        self.assertFalse(os.path.exists(os.path.join(self._temp_dir.name, "x")))
+
+    def test_reject_sibling_path(self):
+        with tarfile.open(self.tar_path, "w") as tar_file:
+            _add_file(tar_file, "../geocells2/x")
+
+        self.assertRaises(Exception, self._extract)
+        self.assertFalse(os.path.exists(os.path.join(self._temp_dir.name, "geocells2")))
+
+    def test_reject_absolute_path(self):
+        absolute_path = os.path.join(self._temp_dir.name, "absolute")
+        with tarfile.open(self.tar_path, "w") as tar_file:
+            _add_file(tar_file, absolute_path)
+
+        self.assertRaises(Exception, self._extract)
+        self.assertFalse(os.path.exists(absolute_path))
+
+    def test_reject_symlink_outside(self):
+        with tarfile.open(self.tar_path, "w") as tar_file:
+            _add_symlink(tar_file, "Copernicus_DSM_30_N41_00_E011_00_DEM.tif", "../outside")
+            _add_symlink(tar_file, "absolute_DEM.tif", "/etc/passwd")
+
+        for link_index in range(2):
+            with tarfile.open(self.tar_path) as tar_file:
+                member = tar_file.getmembers()[link_index]
+                self.assertRaises(Exception, safe_extract, tar_file, self.output_dir, [member])
+
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_extract_symlink_inside(self):
+        with tarfile.open(self.tar_path, "w") as tar_file:
+            _add_file(tar_file, "DEM/Copernicus_DSM_30_N41_00_E011_00_DEM.tif")
+            _add_symlink(tar_file, "DEM/link_DEM.tif", "Copernicus_DSM_30_N41_00_E011_00_DEM.tif")
+
+        self._extract()
+
+        self.assertTrue(os.path.islink(os.path.join(self.output_dir, "DEM", "link_DEM.tif")))
+
+
+# source geocell no-data value
+SRC_NODATA = -32767.0
+
+
+def _write_geocell(file_path: str, latitude: int, longitude: int, size: int, nodata_corner: bool = False):
+    """write a synthetic float32 1 degree geocell, having source no-data in its upper left corner if asked"""
+    dataset = gdal.GetDriverByName("GTiff").Create(file_path, size, size, 1, gdal.GDT_Float32)
+    dataset.SetGeoTransform((longitude, 1.0 / size, 0.0, latitude + 1, 0.0, -1.0 / size))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    dataset.SetProjection(srs.ExportToWkt())
+
+    # smooth slope, so that resampling differences stay small
+    rows, cols = np.mgrid[0:size, 0:size]
+    elevation = (100.0 + 0.25 * rows + 0.35 * cols).astype(np.float32)
+    if nodata_corner:
+        elevation[: size // 4, : size // 4] = SRC_NODATA
+
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(SRC_NODATA)
+    band.WriteArray(elevation)
+    dataset = None
+
+
+def _former_mgrs_dem(dem_downloader: DemDownloader, dem_files: list[str], output: str):
+    """DEM as produced before the VRT mosaic: Int16 GeoTIFF mosaic having its no-data replaced by 0, then warped"""
+    mosaic = os.path.join(os.path.dirname(output), "former_mosaic.tif")
+    options = gdal.WarpOptions(dstNodata=-20000, outputType=gdal.GDT_Int16, dstSRS="EPSG:4326")
+    dataset = gdal.Warp(mosaic, dem_files, options=options)
+    dem_band = dataset.GetRasterBand(1)
+    dem_arr = dem_band.ReadAsArray()
+    dem_arr[dem_arr == -20000] = 0
+    dem_band.WriteArray(dem_arr)
+    dem_band.FlushCache()
+    dataset = None
+
+    extent = dem_downloader.get_tile_extent(True)
+    options = gdal.WarpOptions(
+        dstSRS=f"EPSG:{dem_downloader.mgrs_def['EPSG']}",
+        xRes=dem_downloader.resolution,
+        yRes=dem_downloader.resolution,
+        resampleAlg="cubicspline",
+        outputType=gdal.GDT_Int16,
+        outputBounds=(extent[0], extent[2], extent[1], extent[3]),
+    )
+    gdal.Warp(output, mosaic, options=options)
+
+
+class TestMgrsDem(TestCase):
+    """DemDownloader mosaic and reframe test class, with synthetic geocells"""
+
+    def setUp(self):
+        self._temp_dir = TemporaryDirectory()
+        arg = Arguments()
+        arg.dem_local_url = self._temp_dir.name
+        self.dem_downloader = DemDownloader(arg)
+        self.dem_downloader.temp_directory = TemporaryDirectory(dir=self._temp_dir.name)
+
+        # 33TTG needs geocells N41/N42 E011/E012: leave N42 E012 out and put source no-data in N41 E011
+        geocells_dir = os.path.join(self._temp_dir.name, "geocells")
+        os.makedirs(geocells_dir)
+        self.dem_files = []
+        for latitude, longitude in ((41, 11), (41, 12), (42, 11)):
+            dem_file = os.path.join(geocells_dir, f"Copernicus_DSM_30_N{latitude}_00_E0{longitude}_00_DEM.tif")
+            _write_geocell(dem_file, latitude, longitude, 200, nodata_corner=(latitude, longitude) == (41, 11))
+            self.dem_files.append(dem_file)
+
+    def tearDown(self):
+        self.dem_downloader.temp_directory.cleanup()
+        self._temp_dir.cleanup()
+
+    def test_same_as_former_mosaic(self):
+        former_dem = os.path.join(self._temp_dir.name, "former_dem.tif")
+        _former_mgrs_dem(self.dem_downloader, self.dem_files, former_dem)
+
+        self.dem_downloader.create_mgrs_dem(self.dem_files)
+
+        former = gdal.Open(former_dem)
+        dem = gdal.Open(self.dem_downloader.dem_output)
+
+        # same extent, grid and projection
+        self.assertEqual((dem.RasterXSize, dem.RasterYSize), (former.RasterXSize, former.RasterYSize))
+        self.assertEqual(dem.GetGeoTransform(), former.GetGeoTransform())
+        self.assertEqual(dem.GetProjection(), former.GetProjection())
+
+        # same no-data handling: no-data only flagged, missing geocell and source no-data are 0
+        dem_band = dem.GetRasterBand(1)
+        former_band = former.GetRasterBand(1)
+        self.assertEqual(dem_band.DataType, gdal.GDT_Int16)
+        self.assertEqual(dem_band.GetNoDataValue(), former_band.GetNoDataValue())
+        self.assertEqual(dem_band.GetNoDataValue(), DEM_NODATA)
+
+        dem_arr = dem_band.ReadAsArray()
+        former_arr = former_band.ReadAsArray()
+        self.assertFalse((dem_arr == DEM_NODATA).any())
+        self.assertTrue((dem_arr == 0).any())
+
+        # DEM is now resampled from float geocells instead of an Int16 mosaic: allow rounding differences,
+        # and a few pixels along value discontinuities (0 areas edges) where the former mosaic grid may slightly differ
+        diff = np.abs(dem_arr.astype(np.int32) - former_arr)
+        self.assertLess(np.count_nonzero(diff > 1), diff.size // 1000)
+        self.assertLess(np.count_nonzero((dem_arr == 0) != (former_arr == 0)), diff.size // 1000)